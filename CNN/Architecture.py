@@ -0,0 +1,40 @@
+'''
+The detection model architecture trained by TrainInRam.py and SweepHyperparameters.py
+'''
+from keras.models import Sequential
+from keras.layers import Dense, Dropout, Activation, Flatten, Conv2D, MaxPooling2D, BatchNormalization
+from keras.optimizers import Adam
+
+
+def buildModel(numGroups=4, layer_size=96, dropout1=0.7, dropout2=0.7, lr=0.008):
+    """Compiled model: a conv layer, numGroups groups of two conv layers doubling layer_size after each group,
+    and two dense layers of twice the last width before the sigmoid output"""
+    model = Sequential()
+    model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu", input_shape=(128, 128, 1)))
+    model.add(BatchNormalization())
+    model.add(MaxPooling2D(pool_size=(3,3)))
+
+    for _ in range(numGroups):
+        model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu"))
+        model.add(BatchNormalization())
+        model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu"))
+        model.add(BatchNormalization())
+        model.add(MaxPooling2D(pool_size=(2,2)))
+        model.add(Dropout(dropout1))
+        layer_size *= 2
+
+    model.add(Flatten())
+
+    layer_size *= 2
+
+    for _ in range(2):
+        model.add(Dense(layer_size, activation='relu'))
+        model.add(BatchNormalization())
+        model.add(Dropout(dropout2))
+
+    model.add(Dense(1))
+    model.add(Activation('sigmoid'))
+    model.compile(loss='binary_crossentropy',
+                  optimizer=Adam(lr=lr),
+                  metrics=['accuracy'])
+    return model
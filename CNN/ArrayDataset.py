@@ -0,0 +1,64 @@
+'''
+Loads the memory-mapped train/test arrays written by DataUndersampler and serves float32 batches from them
+'''
+import json
+import os
+import numpy as np
+import keras
+from Quantization import dequantize, storageScale
+
+INFO_FILE = "datainfo.json"
+
+
+def saveDatasetInfo(prefix, storage, crop=False):
+    with open(os.path.join(prefix, INFO_FILE), 'w') as f:
+        json.dump({'storage': storage, 'scale': storageScale(storage), 'crop': crop}, f)
+
+
+def loadDatasetInfo(prefix):
+    """Returns the storage info of a dataset folder, folders without one hold float32 slices"""
+    infoPath = os.path.join(prefix, INFO_FILE)
+    if not os.path.exists(infoPath):
+        return {'storage': 'float32', 'scale': 1.0}
+    with open(infoPath) as f:
+        return json.load(f)
+
+
+def loadArrays(prefix):
+    """Returns X_train, X_test, y_train, y_test memory-mapped, with y as the positive class column, and the
+    scale that turns stored X values into normalized float32 values"""
+    X_train = np.load(prefix + "dataxtrain.npy", mmap_mode='r')
+    X_test = np.load(prefix + "dataxtest.npy", mmap_mode='r')
+    y_train = np.load(prefix + "dataytrain.npy", mmap_mode='r')
+    y_test = np.load(prefix + "dataytest.npy", mmap_mode='r')
+    return X_train, X_test, y_train[:,1], y_test[:,1], loadDatasetInfo(prefix)['scale']
+
+
+class ArraySequence(keras.utils.Sequence):
+    """Serves batches of (possibly quantized) memory-mapped arrays, dequantized to float32 on the fly.
+    Shuffling shuffles the batch order and reads each batch as a sorted set of rows to keep disk reads local"""
+    def __init__(self, X, y, batch_size=32, scale=1.0, shuffle=True):
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.scale = scale
+        self.shuffle = shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.X) / self.batch_size))
+
+    def on_epoch_end(self):
+        self.indexes = np.arange(len(self.X))
+        if self.shuffle:
+            np.random.shuffle(self.indexes)
+
+    def __getitem__(self, index):
+        if self.shuffle:
+            rows = np.sort(self.indexes[index*self.batch_size:(index+1)*self.batch_size])
+            X = self.X[rows]
+            y = self.y[rows]
+        else:
+            X = self.X[index*self.batch_size:(index+1)*self.batch_size]
+            y = self.y[index*self.batch_size:(index+1)*self.batch_size]
+        return dequantize(X, self.scale), np.asarray(y, np.float32)
@@ -0,0 +1,72 @@
+'''
+Compares the viewer's exhaustive detection with the early-exit cascade (MotionDetector.predictCascade):
+slices evaluated per volume, wall time and whether both modes flag the same volumes
+'''
+import glob
+import os
+import sys
+import time
+import numpy as np
+import nibabel as nib
+
+#share detection code with the viewer
+sys.path.append('../Viewer/src/main/python/brAInzViewer')
+from Calibration import DEFAULT_CALIBRATION, scoreVolumes, stackPredictions
+from MachineLearning import MotionDetector, DetectionReader
+
+dataPath = "../Data/"
+#number of scans to benchmark on, None for all of them
+numScans = 5
+modelPath = "models/model_v4.h5"
+detectSliceRange = (78, 178)
+detectResizeDimension = (128, 128)
+confidenceThreshold = DEFAULT_CALIBRATION['detectConfidenceThreshold']
+proportionThreshold = DEFAULT_CALIBRATION['detectSliceNumProportionThreshold']
+#cumulative slice counts after which the cascade checks whether the volume is decided
+stages = (4, 12)
+clearThreshold = 0.1
+
+#%%
+motionDetector = MotionDetector()
+motionDetector.setModel(modelPath, detectSliceRange, detectResizeDimension)
+
+niiPaths = sorted(glob.glob(os.path.join(dataPath, '*.nii')) + glob.glob(os.path.join(dataPath, '*.nii.gz')))
+niiPaths = niiPaths[:numScans]
+
+#%%
+results = {'exhaustive': (list(), 0.0), 'cascade': (list(), 0.0)}
+for niiPath in niiPaths:
+    print(niiPath)
+    reader = DetectionReader(nib.load(niiPath, keep_file_open=True), detectSliceRange)
+    #read every volume once up front so the timings only cover the model
+    planes = [reader.read(v) for v in range(reader.numVolumes())]
+
+    start = time.time()
+    exhaustive = [motionDetector.predictPlanes(*p) for p in planes]
+    exhaustiveTime = time.time() - start
+
+    start = time.time()
+    cascade = [motionDetector.predictCascade(*p, confidenceThreshold, proportionThreshold, stages, clearThreshold)
+               for p in planes]
+    cascadeTime = time.time() - start
+
+    for name, predictions, elapsed in (('exhaustive', exhaustive, exhaustiveTime), ('cascade', cascade, cascadeTime)):
+        scans, total = results[name]
+        scans.append(stackPredictions(predictions))
+        results[name] = (scans, total + elapsed)
+
+#%%
+exhaustive = np.concatenate(results['exhaustive'][0])
+cascade = np.concatenate(results['cascade'][0])
+flaggedExhaustive, scoresExhaustive = scoreVolumes(exhaustive, confidenceThreshold, proportionThreshold)
+flaggedCascade, scoresCascade = scoreVolumes(cascade, confidenceThreshold, proportionThreshold)
+
+for name, predictions in (('Exhaustive', exhaustive), ('Cascade', cascade)):
+    elapsed = results[name.lower()][1]
+    print("{}: {:.2f} slices evaluated per volume, {:.1f}s, {:.1f} ms per volume".format(
+        name, np.sum(~np.isnan(predictions)) / len(predictions), elapsed, elapsed / len(predictions) * 1000))
+print("Speedup: {:.2f}x".format(results['exhaustive'][1] / max(results['cascade'][1], 1e-9)))
+print("Volumes flagged: exhaustive {}, cascade {}, disagreeing {}".format(
+    int(flaggedExhaustive.sum()), int(flaggedCascade.sum()), int(np.sum(flaggedExhaustive != flaggedCascade))))
+print("Flagged volume scores identical:",
+      np.array_equal(scoresExhaustive[flaggedCascade].astype(int), scoresCascade[flaggedCascade].astype(int)))
@@ -0,0 +1,103 @@
+'''
+Calibrates the viewer's volume level detection parameters (detectConfidenceThreshold,
+detectSliceNumProportionThreshold and autoRemoveThreshold) against a reference list of bad volumes.
+Slice predictions are read from the _predictions.npz files the viewer caches next to each scan when it runs
+detection, scans without one are run through the detector here first. Writes the best setting to a calibration
+file for the viewer (BRAINZ_CALIBRATION) and every setting's scores to a csv
+'''
+import csv
+import glob
+import os
+import sys
+import numpy as np
+import nibabel as nib
+
+#share detection and calibration code with the viewer
+sys.path.append('../Viewer/src/main/python/brAInzViewer')
+from Calibration import (DEFAULT_CALIBRATION, gridSearch, loadPredictions, readReferenceList, saveCalibration,
+                         savePredictions, scanName, stackPredictions)
+
+dataPath = "../Data/"
+#csv of bad volumes, 'Scan ID,Bad Volumes' with 1-indexed volumes separated by ;
+referencePath = "Bad750Volumes.csv"
+#only score scans that appear in the reference list, set to False if unlisted scans are known to be clean
+onlyListedScans = True
+modelPath = "models/model_v4.h5"
+#viewer detection settings, the model only needs loading for scans without cached predictions
+detectSliceRange = (78, 178)
+detectResizeDimension = (128, 128)
+outputPath = "Inputs/calibration.json"
+resultsPath = "Inputs/calibrationResults.csv"
+#metric the best setting is chosen on: 'f1', 'precision' or 'recall'
+optimizeFor = 'f1'
+#minimum precision of the chosen setting, so auto removal does not throw away good volumes
+minPrecision = 0.0
+
+confidenceThresholds = np.round(np.arange(0.5, 1.0, 0.05), 2)
+proportionThresholds = np.round(np.arange(0.1, 1.01, 0.1), 2)
+autoRemoveThresholds = np.arange(50, 100, 5)
+
+
+#%%
+def detectScan(niiPath, motionDetector):
+    """Runs the viewer's detector on every volume of a scan, reading only the sampled planes, and caches the
+    slice predictions"""
+    reader = DetectionReader(nib.load(niiPath, keep_file_open=True), detectSliceRange)
+    predictions = list()
+    for v in range(reader.numVolumes()):
+        predictions.append(motionDetector.predictPlanes(*reader.read(v)))
+    predictions = stackPredictions(predictions)
+    savePredictions(niiPath, predictions, modelPath)
+    return predictions
+
+
+#%%
+reference = readReferenceList(referencePath)
+niiPaths = sorted(glob.glob(os.path.join(dataPath, '*.nii')) + glob.glob(os.path.join(dataPath, '*.nii.gz')))
+if onlyListedScans:
+    niiPaths = [path for path in niiPaths if scanName(path) in reference]
+print(len(niiPaths), "scans to calibrate on")
+
+motionDetector = None
+scanPredictions = list()
+isBad = list()
+for niiPath in niiPaths:
+    predictions = loadPredictions(niiPath, modelPath)
+    if predictions is None:
+        if motionDetector is None:
+            from MachineLearning import MotionDetector, DetectionReader
+            motionDetector = MotionDetector()
+            motionDetector.setModel(modelPath, detectSliceRange, detectResizeDimension)
+        print("Running detection on", niiPath)
+        predictions = detectScan(niiPath, motionDetector)
+    badVols = reference.get(scanName(niiPath), set())
+    scanPredictions.append(predictions)
+    isBad.append(np.isin(np.arange(len(predictions)), list(badVols)))
+
+numSlices = max(p.shape[1] for p in scanPredictions)
+predictions = np.concatenate([np.pad(p, ((0, 0), (0, numSlices - p.shape[1])), mode='constant',
+                                     constant_values=np.nan)
+                              for p in scanPredictions])
+isBad = np.concatenate(isBad)
+print(len(predictions), "volumes,", int(isBad.sum()), "bad")
+
+#%%
+results = gridSearch(predictions, isBad, confidenceThresholds, proportionThresholds, autoRemoveThresholds)
+with open(resultsPath, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+    writer.writeheader()
+    writer.writerows(results)
+
+current = gridSearch(predictions, isBad, *([DEFAULT_CALIBRATION[key]] for key in DEFAULT_CALIBRATION))[0]
+candidates = [r for r in results if r['precision'] >= minPrecision] or results
+best = max(candidates, key=lambda r: (r[optimizeFor], r['precision'], r['recall']))
+
+fmt = "confidence {detectConfidenceThreshold:.2f} proportion {detectSliceNumProportionThreshold:.2f} " \
+      "autoRemove {autoRemoveThreshold:.0f}: precision {precision:.4f} recall {recall:.4f} f1 {f1:.4f} " \
+      "(tp {tp} fp {fp} fn {fn})"
+print("Default ", fmt.format(**current))
+print("Best    ", fmt.format(**best))
+
+saveCalibration(outputPath, best, {key: best[key] for key in ('tp', 'fp', 'fn', 'precision', 'recall', 'f1')},
+                modelPath)
+print("Saved calibration to", outputPath)
@@ -0,0 +1,38 @@
+'''
+Checks that storing slices in reduced precision does not change model accuracy
+Predicts a sample of float32 test slices as stored, and after a round trip through each storage type
+'''
+import numpy as np
+from keras.models import load_model
+from ArrayDataset import loadArrays
+from Quantization import quantize, dequantize, storageScale
+
+#dataset written with storage = 'float32'
+prefix = "DataArrays/400000/"
+modelPath = 'models/model_v4.h5'
+numSlices = 20000
+storageTypes = ['float16', 'uint8']
+seed = 1
+
+#%%
+X_train, X_test, y_train, y_test, scale = loadArrays(prefix)
+if scale != 1.0:
+    raise ValueError("The reference dataset must be stored as float32")
+
+rows = np.sort(np.random.RandomState(seed).choice(len(X_test), min(numSlices, len(X_test)), replace=False))
+X = np.asarray(X_test[rows], np.float32)
+y = np.asarray(y_test[rows])
+
+model = load_model(modelPath)
+reference = model.predict(X, batch_size=256)[:,0]
+referenceAccuracy = np.mean((reference > 0.5) == y)
+print("float32 accuracy: %0.4f" % referenceAccuracy)
+
+#%%
+for storage in storageTypes:
+    X_roundTrip = dequantize(quantize(X, storage), storageScale(storage))
+    prob = model.predict(X_roundTrip, batch_size=256)[:,0]
+    accuracy = np.mean((prob > 0.5) == y)
+    flipped = np.sum((prob > 0.5) != (reference > 0.5))
+    print("%s accuracy: %0.4f (delta %+0.4f), max probability change %0.4f, %d of %d predictions flipped" %
+          (storage, accuracy, accuracy - referenceAccuracy, np.max(np.abs(prob - reference)), flipped, len(y)))
@@ -1,20 +1,38 @@
+import os
+import sys
 import numpy as np
 import nibabel as nib
 import keras
 import cv2
+from collections import OrderedDict
+from SliceIndex import SliceIndex
+
+#brain bounding box cropping is shared with the viewer's detection
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../Viewer/src/main/python/brAInzViewer'))
+from Preprocessing import scanBrainBox, cropSlice, planeBox
+
+#axis each slice type cuts across
+SLICE_AXES = {0: 2, 1: 0, 2: 1}
 
 class DataGenerator(keras.utils.Sequence):
     """Generates data for Keras to process.nii files"""
-    def __init__(self, list_IDs, labels, max_brightness, batch_size=64, dim=(128,64,1), n_channels=1,
-                 n_classes=10, shuffle=True):
-        """- list_IDs should be a list of tupples, each tupples consists of (file_path, vol_num, slice_type, slice_num).
+    def __init__(self, list_IDs, labels=None, max_brightness=None, batch_size=64, dim=(128,64,1), n_channels=1,
+                 n_classes=10, shuffle=True, nii_cache_size=32, crop=False):
+        """- list_IDs should be a list of tupples, each tupples consists of (file_path, vol_num, slice_type, slice_num),
+           or a SliceIndex, in which case labels and max_brightness default to the ones stored in the index.
            - labels should be a dictionary, the key is a tupple of (file_path, vol_num, slice_type, slice_num), and value
             is the label.
            - max_brightness should be a dictionary, the key is tuple of (file_path and vol_num), value is max voxel brightness of the volume, 
            used for normalizaing image data in the volume.
+           - nii_cache_size is the number of opened nii files whose parsed headers are kept, least recently used
+           files are dropped first.
+           - crop crops slices to the scan's brain bounding box (Preprocessing.scanBrainBox, cached next to the scan)
+           before resizing, and only the box is read from disk.
         """
         
         'Initialization'
+        if isinstance(list_IDs, SliceIndex) and max_brightness is None:
+            max_brightness = list_IDs.getMaxVals()
         self.dim = dim
         self.batch_size = batch_size
         self.labels = labels
@@ -23,6 +41,10 @@ class DataGenerator(keras.utils.Sequence):
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.shuffle = shuffle
+        self.nii_cache = OrderedDict()
+        self.nii_cache_size = nii_cache_size
+        self.crop = crop
+        self.boxes = dict()  # Key: file_path, Value: brain bounding box
         self.on_epoch_end()
 
     def __len__(self):
@@ -35,10 +57,15 @@ class DataGenerator(keras.utils.Sequence):
         indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
 
         # Find list of IDs
-        list_IDs_temp = [self.list_IDs[k] for k in indexes]
+        if isinstance(self.list_IDs, SliceIndex):
+            list_IDs_temp = self.list_IDs.getIds(indexes)
+            labels_temp = self.list_IDs.labels[indexes] if self.labels is None else None
+        else:
+            list_IDs_temp = [self.list_IDs[k] for k in indexes]
+            labels_temp = None
 
         # Generate data
-        X, y = self.__data_generation(list_IDs_temp)
+        X, y = self.__data_generation(list_IDs_temp, labels_temp)
 
         return X, y
 
@@ -57,9 +84,33 @@ class DataGenerator(keras.utils.Sequence):
         """Ensure consistent size of each slice of data"""
         return cv2.resize(img, (self.dim[0],self.dim[1]), interpolation=cv2.INTER_NEAREST)
     
+    def __get_nii(self, file_path):
+        """Returns the nii image of a file from the LRU cache, loading it (header only) if needed"""
+        nii_file = self.nii_cache.pop(file_path, None)
+        if nii_file is None:
+            nii_file = nib.load(file_path)
+            if len(self.nii_cache) >= self.nii_cache_size:
+                self.nii_cache.popitem(last=False)
+        self.nii_cache[file_path] = nii_file
+        return nii_file
+    
+    def __get_box(self, file_path):
+        if file_path not in self.boxes:
+            self.boxes[file_path] = scanBrainBox(self.__get_nii(file_path))
+        return self.boxes[file_path]
+    
+    def __cut_slice(self, data, slice_type, slice_num):
+        """Cut a slice out of a volume (or the 4d nii dataobj when the volume index is already applied)"""
+        if slice_type == 0:  # Axial slice
+            return data[:,:,slice_num]
+        elif slice_type == 1:  # Sagittal slice
+            return data[slice_num,:,:]
+        elif slice_type == 2:  # Coronal slice
+            return data[:,slice_num,:]
+    
     def load_nii_slice(self, file_path, vol_num, slice_type, slice_num):
         """Load a single slice from nii file"""
-        nii_file = nib.load(file_path)
+        nii_file = self.__get_nii(file_path)
         
         if slice_type == 0:  # Axial slice
             img = nii_file.dataobj[:,:,slice_num,vol_num]
@@ -68,20 +119,53 @@ class DataGenerator(keras.utils.Sequence):
         elif slice_type == 2:  # Coronal slice
             img = nii_file.dataobj[:,slice_num,:,vol_num]
         
+        if self.crop:
+            img = cropSlice(img, self.__get_box(file_path), SLICE_AXES[slice_type])
         normalized = self.__normalize(img, file_path, vol_num)
         
         return self.__resize(normalized)
     
+    def load_nii_slices(self, list_IDs):
+        """Load many slices, yields (index into list_IDs, slice).
+        Slices are grouped by (file_path, vol_num) so each volume is read from disk once and all of its requested slices
+        are cut from that read, which means slices are not yielded in list_IDs order"""
+        groups = OrderedDict()
+        for index, (file_path, vol_num, slice_type, slice_num) in enumerate(list_IDs):
+            groups.setdefault((file_path, vol_num), list()).append((index, slice_type, slice_num))
+        
+        for (file_path, vol_num), requests in groups.items():
+            if self.crop:
+                yield from self.__load_cropped_slices(file_path, vol_num, requests)
+                continue
+            volume = np.asanyarray(self.__get_nii(file_path).dataobj[:,:,:,vol_num])
+            for index, slice_type, slice_num in requests:
+                img = self.__cut_slice(volume, slice_type, slice_num)
+                yield index, self.__resize(self.__normalize(img, file_path, vol_num))
+    
+    def __load_cropped_slices(self, file_path, vol_num, requests):
+        """Reads only the brain bounding box of a volume and cuts the requested slices from it.
+        Slices outside the box along their own axis are background and come back as zeros"""
+        box = self.__get_box(file_path)
+        (x0, x1), (y0, y1), (z0, z1) = box
+        volume = np.asanyarray(self.__get_nii(file_path).dataobj[x0:x1, y0:y1, z0:z1, vol_num])
+        for index, slice_type, slice_num in requests:
+            start, end = box[SLICE_AXES[slice_type]]
+            if start <= slice_num < end:
+                img = self.__normalize(self.__cut_slice(volume, slice_type, slice_num - start), file_path, vol_num)
+            else:
+                img = np.zeros([e - s for s, e in planeBox(box, SLICE_AXES[slice_type])])
+            yield index, self.__resize(img)
+    
     def __get_slice_label(self, file_path, vol_num, slice_type, slice_num):
         """Look for slice label given file_path, volume, slice_type, and slice_num,
         returns a default_label value if the label not found in the dictionary"""
         default_label = 0
         return self.labels.get((file_path, vol_num, slice_type, slice_num), default_label)
     
-    def __data_generation(self, list_IDs_temp):
+    def __data_generation(self, list_IDs_temp, labels_temp=None):
         'Generates data containing batch_size samples' # X : (n_samples, *dim, n_channels)
         # Initialization
-        X = np.empty((self.batch_size, *self.dim, self.n_channels))
+        X = np.empty((self.batch_size, *self.dim, self.n_channels), np.float32)
         y = np.empty((self.batch_size), dtype=int)
 
 #         # Generate data for standard images
@@ -91,10 +175,13 @@ class DataGenerator(keras.utils.Sequence):
 #             # Store class
 #             y[i] = self.labels[ID]
 
-        # Generate data for nii slices
-        for i, ID in enumerate(list_IDs_temp):
-            file_path, vol_num, slice_type, slice_num = ID
-            X[i,:,:,0] = self.__load_nii_slice(file_path, vol_num, slice_type, slice_num)
-            y[i] = self.__get_slice_label(file_path, vol_num, slice_type, slice_num)
+        # Generate data for nii slices, reading each volume of the batch once
+        for i, img in self.load_nii_slices(list_IDs_temp):
+            X[i,:,:,0] = img
+        if labels_temp is not None:
+            y[:] = labels_temp
+        else:
+            for i, ID in enumerate(list_IDs_temp):
+                y[i] = self.__get_slice_label(*ID)
 
         return X, keras.utils.to_categorical(y, num_classes=self.n_classes)
\ No newline at end of file
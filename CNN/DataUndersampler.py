@@ -1,12 +1,15 @@
 '''
 Randomly chooses nii files to be part of train and test
+Samples slices from the test and train nii files so both sets have the same fraction of bad slices
 Pulls appropriate slices from the test and train nii files for test and train sets
 '''
 import numpy as np
 import keras
-from DataGeneratorSimple import DataGenerator
 from LabelGenerator import LabelGenerator
-import random
+from SliceIndex import SliceIndex
+from SliceExtraction import extractSlices
+from ArrayDataset import saveDatasetInfo
+from Quantization import storageDtype
 import os
 
 outputPath = "DataArrays/"
@@ -18,126 +21,117 @@ trainTestSplit = 0.2
 numSamples = 600000
 #allowable distance from the middle of the volume to select slices from
 gap = 50
+#number of worker processes pulling slices, 1 pulls them in this process
+numWorkers = os.cpu_count()
+#seed of the train/test split and sample selection, for reproducible datasets
+seed = 1
+#storage type of the slices: 'uint8' (1/255 steps), 'float16' or 'float32'
+storage = 'uint8'
+#crop slices to each scan's brain bounding box before resizing, the viewer must then detect with detectCrop
+crop = False
+#slice index saved by an earlier run, set to None to generate it from the nii files and label csv
+sliceIndexPath = None
 
 #%%
-labelGenerator = LabelGenerator()
-labelGenerator.setSliceStart(128-gap)
-labelGenerator.setSliceEnd(128+gap)
-labelGenerator.generateLabels()
-
-#Dictionary of IDs. 
-#ID format: (filepath, volume, direction, slice number)
-idList = labelGenerator.get_idList()
-#Dictionary of labels with the ID as the key
-labels = labelGenerator.get_labels()
+if sliceIndexPath is not None:
+    sliceIndex = SliceIndex.load(sliceIndexPath)
+else:
+    labelGenerator = LabelGenerator()
+    labelGenerator.setSliceStart(128-gap)
+    labelGenerator.setSliceEnd(128+gap)
+    labelGenerator.generateLabels()
+    #Columnar index of IDs and labels
+    #ID format: (filepath, volume, direction, slice number)
+    sliceIndex = labelGenerator.get_sliceIndex()
+
 #maximum values for each volume of each nii file
-maxVals = labelGenerator.get_maxVals()
+maxVals = sliceIndex.getMaxVals()
 
-maxSamples = len(idList)
+maxSamples = len(sliceIndex)
 print(maxSamples, "potential slices")
 print(numSamples, "desired slices\n")
 
 #%%
-# Parameters for data generator
-params = {'labels': labels,
-          'max_brightness': maxVals,
-          'dim': (128,128),
-          'batch_size': 32,
-          'n_classes': 2,
-          'n_channels': 1,
-          'shuffle': True}
-
-# Generator used to pull resized and normalized slices from the nii files
-dataGen = DataGenerator(idList, **params)
+print("Selecting positive and negative indices for train and test sets")
+rng = np.random.RandomState(seed)
 
-#%%
-testPositiveFraction = 0
-while (testPositiveFraction < badFraction-0.025) or (testPositiveFraction > badFraction+0.025):
-    print("Selecting positive and negative indices for train and test sets")
-    
-    #all labels in list form
-    labelVals = [labels[tempId] for tempId in idList]
-    
-    #all potential negative and positive indices
-    allNegativeIndices = [i for i, x in enumerate(labelVals) if x == 0]
-    allPositiveIndices = [i for i, x in enumerate(labelVals) if x == 1]
-    
-    #randomly choose some indices
-    positiveChoices = random.sample(range(len(allPositiveIndices)), int(numSamples*badFraction))
-    negativeChoices = random.sample(range(len(allNegativeIndices)), int(numSamples*(1-badFraction)))
-    
-    #subset of indices randomly chosen
-    negativeSamples = [allNegativeIndices[i] for i in negativeChoices]
-    positiveSamples = [allPositiveIndices[i] for i in positiveChoices]
-    
-    print(len(negativeSamples), "negative samples")
-    print(len(positiveSamples), "positive samples")
-    
-    #allSamples = negativeSamples.union(positiveSamples)
-    allSamples = negativeSamples + positiveSamples
-    
-    ##Train Test Split 
-    niiFiles = labelGenerator.get_niiFiles()
-    random.shuffle(niiFiles)
-    splitIndex = int(trainTestSplit*len(niiFiles))
-    testNiis = niiFiles[0:splitIndex]
-    
-    ##Count number of test samples for sanity
-    numTestSamples = 0
-    numTestPositive = 0
-    for i in allSamples:
-        tempId = idList[i]
-        if tempId[0] in testNiis:
-            numTestSamples += 1
-            if labels[tempId] == 1:
-                numTestPositive += 1
-    testPositiveFraction = numTestPositive/numTestSamples
-    print(numTestSamples, "test samples, ", numTestSamples/numSamples*100, "percent test size")
-    print(numTestPositive, "test positive samples, ", testPositiveFraction*100, "percent test positive\n")
-    if (testPositiveFraction < badFraction-0.025) or (testPositiveFraction > badFraction+0.025):
-        print("****Selecting slices again, test positive fraction out of range*****\n")
+#nii file index and label of every potential slice
+niiFiles = sliceIndex.files
+idFiles = sliceIndex.fileIds
+labelVals = sliceIndex.labels
+
+##Train Test Split by nii file, so no scan has slices in both sets
+testFiles = rng.permutation(len(niiFiles))[:int(trainTestSplit*len(niiFiles))]
+isTest = np.isin(idFiles, testFiles)
+
+##Stratified sampling: each set gets exactly badFraction positives
+numTestSamples = int(numSamples*trainTestSplit)
+numTestPositive = int(numTestSamples*badFraction)
+numTrainPositive = int(numSamples*badFraction) - numTestPositive
+
+def sampleIndices(mask, count, name):
+    """Randomly choose count indices of the ID list where mask is True"""
+    candidates = np.flatnonzero(mask)
+    if count > len(candidates):
+        raise ValueError("Not enough {} slices: {} wanted, {} available".format(name, count, len(candidates)))
+    #sorted so slices of the same volume are pulled together
+    return np.sort(rng.choice(candidates, count, replace=False))
+
+testSamples = np.concatenate([
+    sampleIndices(isTest & (labelVals == 1), numTestPositive, "test positive"),
+    sampleIndices(isTest & (labelVals == 0), numTestSamples - numTestPositive, "test negative")])
+trainSamples = np.concatenate([
+    sampleIndices(~isTest & (labelVals == 1), numTrainPositive, "train positive"),
+    sampleIndices(~isTest & (labelVals == 0), numSamples - numTestSamples - numTrainPositive, "train negative")])
+
+print(numTestSamples, "test samples, ", numTestSamples/numSamples*100, "percent test size")
+print(numTestPositive, "test positive samples, ", numTestPositive/numTestSamples*100, "percent test positive")
+print(numTrainPositive, "train positive samples, ",
+      numTrainPositive/(numSamples-numTestSamples)*100, "percent train positive\n")
 
 #%%
 ##Initialize train and test arrays
+##Arrays are memory-mapped .npy files written in place, so the dataset does not have to fit in RAM
 
 #dimensions of the resized images
 width = 128
 height = 128
 
-print("Pulling slices from generated indices using data generator")
-X_train = np.zeros((numSamples-numTestSamples,width, height, 1), np.float32)
-y_train = np.zeros((numSamples-numTestSamples,2), int)
-X_test = np.zeros((numTestSamples,width, height, 1), np.float32)
-y_test = np.zeros((numTestSamples,2), int)
-count = 0
-testIndex = 0
-trainIndex = 0
-
-## Use the data generator to pull a resized and normalized slice for every
-## slice index
-for i in allSamples:
-    if count%1000 == 0:
-        print(count, "slices pulled")
-    tempId = idList[i]
-    label = labels[tempId]
-    if tempId[0] in testNiis:
-        X_test[testIndex,:,:,0] = dataGen.load_nii_slice(*tempId)
-        y_test[testIndex,] = keras.utils.to_categorical(label,2)
-        testIndex+=1
-    else:
-        X_train[trainIndex,:,:,0] = dataGen.load_nii_slice(*tempId)
-        y_train[trainIndex,] = keras.utils.to_categorical(label,2)
-        trainIndex+=1
-    count+=1
-print(testIndex+1, "test slices pulled")
-print(trainIndex+1, "train slices pulled")
-#%%
-##Save to npy files
 if not os.path.exists(outputPath):
     os.makedirs(outputPath)
+
+print("Pulling slices from generated indices using data generator")
+X_train = np.lib.format.open_memmap(outputPath + "dataxtrain.npy", mode='w+', dtype=storageDtype(storage),
+                                    shape=(numSamples-numTestSamples,width, height, 1))
+y_train = np.lib.format.open_memmap(outputPath + "dataytrain.npy", mode='w+', dtype=int,
+                                    shape=(numSamples-numTestSamples,2))
+X_test = np.lib.format.open_memmap(outputPath + "dataxtest.npy", mode='w+', dtype=storageDtype(storage),
+                                   shape=(numTestSamples,width, height, 1))
+y_test = np.lib.format.open_memmap(outputPath + "dataytest.npy", mode='w+', dtype=int,
+                                   shape=(numTestSamples,2))
+y_test[:] = keras.utils.to_categorical(labelVals[testSamples],2)
+y_train[:] = keras.utils.to_categorical(labelVals[trainSamples],2)
+
+## Work out where every sample goes first, so the arrays come out the same
+## regardless of how many workers pull the slices
+allSamples = np.concatenate([testSamples, trainSamples])
+destinations = [("test", i) for i in range(len(testSamples))] + [("train", i) for i in range(len(trainSamples))]
+
+## Workers pull a resized and normalized slice for every slice index straight
+## into the memory-mapped X arrays, reading each volume once
+X_train.flush()
+X_test.flush()
+outputPaths = {"train": outputPath + "dataxtrain.npy", "test": outputPath + "dataxtest.npy"}
+extractSlices(sliceIndex.getIds(allSamples), destinations, maxVals, outputPaths, (width, height), numWorkers, storage,
+              crop)
+print(len(testSamples), "test slices pulled")
+print(len(trainSamples), "train slices pulled")
+#%%
+##Flush the memory-mapped npy files
 print("Saving split files")
-np.save(outputPath + "dataxtrain.npy", X_train)
-np.save(outputPath + "dataxtest.npy", X_test)
-np.save(outputPath + "dataytrain.npy", y_train)
-np.save(outputPath + "dataytest.npy", y_test)
+for array in (X_train, X_test, y_train, y_test):
+    array.flush()
+del X_train, X_test, y_train, y_test
+#storage type and scale, read by the loaders to dequantize the slices
+saveDatasetInfo(outputPath, storage, crop)
 print("Saved")
\ No newline at end of file
@@ -0,0 +1,136 @@
+'''
+Batched model evaluation with a prediction cache, vectorized threshold sweeps over cached probabilities and
+comparisons of models' accuracy and speed
+'''
+import hashlib
+import os
+import sys
+import time
+import numpy as np
+from sklearn.metrics import f1_score, accuracy_score, recall_score, precision_score
+from Quantization import dequantize
+
+#keras and quantized .tflite models are loaded like the viewer's detector
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../Viewer/src/main/python/brAInzViewer'))
+from MachineLearning import loadDetectionModel
+
+cacheDir = "ScoreCache/"
+_models = dict()
+
+
+def fileHash(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def getModel(modelPath):
+    """Loads a model (keras .h5 or .tflite) once per process"""
+    if modelPath not in _models:
+        _models[modelPath] = loadDetectionModel(modelPath)
+    return _models[modelPath]
+
+
+def predictionCachePath(modelPath, datasetPath):
+    """Cache file of a model's probabilities on a dataset file, keyed by the content hash of the model and
+    the path, size and modification time of the dataset"""
+    status = os.stat(datasetPath)
+    datasetKey = '{}|{}|{}'.format(os.path.realpath(datasetPath), status.st_size, status.st_mtime)
+    datasetHash = hashlib.md5(datasetKey.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cacheDir, '{}_{}.npy'.format(fileHash(modelPath)[:12], datasetHash))
+
+
+def predictInBatches(model, X, scale=1.0, batchSize=256, out=None):
+    """Predicts the positive class probability of every row of a (memory-mapped) array, reading and dequantizing
+    batchSize rows at a time. Writes into out (eg: a memory-mapped file) when given"""
+    if out is None:
+        out = np.empty(len(X), np.float32)
+    for start in range(0, len(X), batchSize):
+        batch = dequantize(X[start:start+batchSize], scale)
+        out[start:start+batchSize] = model.predict_on_batch(batch)[:,0]
+        if (start // batchSize) % 100 == 0:
+            print(min(start + batchSize, len(X)), "of", len(X), "slices predicted")
+    return out
+
+
+def cachedPredictions(modelPath, X, datasetPath, scale=1.0, batchSize=256):
+    """Returns the probabilities of modelPath on X, the array stored in datasetPath. Inference only runs when there is
+    no cached result for this model and dataset, results are streamed to the cache file as they are computed"""
+    cachePath = predictionCachePath(modelPath, datasetPath)
+    if os.path.exists(cachePath):
+        print("Using cached predictions", cachePath)
+        return np.load(cachePath, mmap_mode='r')
+
+    os.makedirs(cacheDir, exist_ok=True)
+    partialPath = cachePath + '.partial'
+    out = np.lib.format.open_memmap(partialPath, mode='w+', dtype=np.float32, shape=(len(X),))
+    predictInBatches(getModel(modelPath), X, scale, batchSize, out)
+    out.flush()
+    del out
+    os.replace(partialPath, cachePath)
+    return np.load(cachePath, mmap_mode='r')
+
+
+def thresholdSweep(y, prob, thresholds):
+    """Confusion counts and metrics of the prediction prob > threshold for every threshold, computed from sorted
+    probabilities with one searchsorted per class instead of thresholding the whole array per threshold"""
+    y = np.asarray(y).astype(bool)
+    prob = np.asarray(prob)
+    thresholds = np.asarray(thresholds, float)
+    positives = np.sort(prob[y])
+    negatives = np.sort(prob[~y])
+
+    tp = len(positives) - np.searchsorted(positives, thresholds, side='right')
+    fp = len(negatives) - np.searchsorted(negatives, thresholds, side='right')
+    fn = len(positives) - tp
+    tn = len(negatives) - fp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+        recall = tp / max(len(positives), 1)
+        fpr = fp / max(len(negatives), 1)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    accuracy = (tp + tn) / max(len(y), 1)
+    return {'threshold': thresholds, 'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn, 'precision': precision,
+            'recall': recall, 'fpr': fpr, 'f1': f1, 'accuracy': accuracy}
+
+
+def rocCurve(y, prob):
+    """Returns (fpr, tpr, auc) over every distinct probability as threshold"""
+    thresholds = np.concatenate([[-np.inf], np.unique(prob), [np.inf]])
+    sweep = thresholdSweep(y, prob, thresholds)
+    fpr, tpr = sweep['fpr'][::-1], sweep['recall'][::-1]
+    auc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+    return fpr, tpr, auc
+
+
+def prCurve(y, prob):
+    """Returns (recall, precision, average precision) over every distinct probability as threshold"""
+    #just below each distinct probability, so prob > threshold includes the slices at that probability
+    thresholds = np.nextafter(np.unique(prob).astype(float), -np.inf)
+    sweep = thresholdSweep(y, prob, thresholds)
+    recall, precision = sweep['recall'][::-1], sweep['precision'][::-1]
+    averagePrecision = np.sum(np.diff(np.concatenate([[0], recall])) * precision)
+    return recall, precision, averagePrecision
+
+
+def classificationScores(y, prob, threshold=0.5):
+    """The ModelAnalysis metrics (macro averaged) of the prediction prob > threshold, and the ROC AUC"""
+    averageType = 'macro'
+    pred = (np.asarray(prob) > threshold).astype(int)
+    return {'accuracy': accuracy_score(y, pred),
+            'recall': recall_score(y, pred, average=averageType),
+            'precision': precision_score(y, pred, average=averageType),
+            'f1': f1_score(y, pred, average=averageType),
+            'auc': rocCurve(y, prob)[2]}
+
+
+def timeVolumePredictions(model, X, volumeBatch=20, numVolumes=50):
+    """Milliseconds per volume predicting volumeBatch slices at a time like the viewer, after one warm-up call"""
+    model.predict(X[:volumeBatch])
+    start = time.time()
+    for v in range(numVolumes):
+        model.predict(X[v*volumeBatch:(v+1)*volumeBatch])
+    return (time.time() - start) / numVolumes * 1000
@@ -0,0 +1,148 @@
+'''
+Prefetching input pipeline for training from nii files, a drop-in replacement for DataGenerator
+'''
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import keras
+from DataGeneratorSimple import DataGenerator
+from SliceIndex import SliceIndex
+
+
+class InputPipeline(keras.utils.Sequence):
+    """Generates float32 batches with the same interface as DataGenerator, but builds batches ahead of time
+    on a thread pool (nibabel reads and cv2 resizes release the GIL), keeps recently decoded slices in memory and
+    reports batches/s. Use it with workers=1 and use_multiprocessing=False, the pipeline has its own workers.
+    Batches must be requested in order: pass shuffle=False to fit_generator, the pipeline shuffles the sample order
+    itself at the end of every epoch. Batches prefetched behind the one requested are dropped"""
+    def __init__(self, list_IDs, labels=None, max_brightness=None, batch_size=64, dim=(128,128), n_channels=1,
+                 n_classes=2, shuffle=True, num_parallel_calls=4, prefetch=8, shuffle_buffer=None,
+                 cache_size=0, report_every=0, crop=False):
+        """- list_IDs, labels, max_brightness, batch_size, dim, n_channels, n_classes and shuffle are the same as
+           DataGenerator's.
+           - num_parallel_calls is the number of threads building batches, prefetch how many batches are built ahead.
+           - shuffle_buffer, when set, shuffles IDs within windows of that many IDs (in list_IDs order) and shuffles
+           the window order, so slices of the same volume tend to land in the same batch and are read together.
+           By default the whole list is shuffled.
+           - cache_size is the number of decoded slices kept in memory, least recently used dropped first.
+           - report_every prints batches/s every that many batches, 0 disables it.
+           - crop crops slices to the scan's brain bounding box before resizing, see DataGenerator."""
+        if isinstance(list_IDs, SliceIndex) and max_brightness is None:
+            max_brightness = list_IDs.getMaxVals()
+        self.list_IDs = list_IDs
+        self.labels = labels
+        self.max_brightness = max_brightness if max_brightness is not None else dict()
+        self.batch_size = batch_size
+        self.dim = dim
+        self.n_channels = n_channels
+        self.n_classes = n_classes
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.shuffle_buffer = shuffle_buffer
+        self.cache_size = cache_size
+        self.report_every = report_every
+        self.crop = crop
+
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=num_parallel_calls)
+        self.pending = dict()  # Key: batch index, Value: future of the batch
+        self.on_epoch_end()
+
+    def __len__(self):
+        'Denotes the number of batches per epoch'
+        return int(np.floor(len(self.list_IDs) / self.batch_size))
+
+    def __getitem__(self, index):
+        'Returns one batch, scheduling the following ones'
+        for ahead in range(index, min(index + self.prefetch + 1, len(self))):
+            if ahead not in self.pending:
+                self.pending[ahead] = self.executor.submit(self.load_batch, ahead)
+        batch = self.pending.pop(index).result()
+        for behind in [i for i in self.pending if i < index]:
+            self.pending.pop(behind).cancel()
+
+        self.batch_count += 1
+        if self.report_every and self.batch_count % self.report_every == 0:
+            print("{:.1f} batches/s".format(self.batches_per_second()))
+        return batch
+
+    def on_epoch_end(self):
+        'Updates indexes after each epoch, batches prefetched for the old order are dropped'
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.indexes = self.epoch_order()
+        self.batch_count = 0
+        self.epoch_start = time.time()
+
+    def epoch_order(self):
+        indexes = np.arange(len(self.list_IDs))
+        if not self.shuffle:
+            return indexes
+        if not self.shuffle_buffer:
+            np.random.shuffle(indexes)
+            return indexes
+        windows = [indexes[i:i + self.shuffle_buffer] for i in range(0, len(indexes), self.shuffle_buffer)]
+        np.random.shuffle(windows)
+        for window in windows:
+            np.random.shuffle(window)
+        return np.concatenate(windows) if windows else indexes
+
+    def batches_per_second(self):
+        return self.batch_count / max(time.time() - self.epoch_start, 1e-9)
+
+    def loader(self):
+        """Returns this thread's DataGenerator, used for its nii cache and slice loading"""
+        if not hasattr(self.local, 'generator'):
+            self.local.generator = DataGenerator(list(), dict(), self.max_brightness, batch_size=self.batch_size,
+                                                 dim=self.dim, n_channels=self.n_channels,
+                                                 n_classes=self.n_classes, shuffle=False, crop=self.crop)
+        return self.local.generator
+
+    def ids_and_labels(self, indexes):
+        if isinstance(self.list_IDs, SliceIndex):
+            ids = self.list_IDs.getIds(indexes)
+            if self.labels is None:
+                return ids, self.list_IDs.labels[indexes]
+        else:
+            ids = [self.list_IDs[k] for k in indexes]
+        return ids, np.array([self.labels.get(ID, 0) for ID in ids], dtype=int)
+
+    def cached_slice(self, ID):
+        with self.cache_lock:
+            img = self.cache.pop(ID, None)
+            if img is not None:
+                self.cache[ID] = img
+            return img
+
+    def cache_slice(self, ID, img):
+        with self.cache_lock:
+            self.cache[ID] = img
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def load_batch(self, index):
+        'Builds one batch of float32 slices and one-hot labels'
+        indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+        ids, y = self.ids_and_labels(indexes)
+        X = np.empty((len(ids), *self.dim, self.n_channels), np.float32)
+
+        missing = list()
+        for i, ID in enumerate(ids):
+            img = self.cached_slice(ID) if self.cache_size else None
+            if img is None:
+                missing.append(i)
+            else:
+                X[i,:,:,0] = img
+
+        for j, img in self.loader().load_nii_slices([ids[i] for i in missing]):
+            i = missing[j]
+            X[i,:,:,0] = img
+            if self.cache_size:
+                self.cache_slice(ids[i], X[i,:,:,0].copy())
+
+        return X, keras.utils.to_categorical(y, num_classes=self.n_classes).astype(np.float32)
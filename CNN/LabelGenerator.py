@@ -3,22 +3,28 @@ Creates a label for slices of each volume of each nii file in the data folder
 '''
 import os
 import pickle
+import sqlite3
+import numpy as np
 import nibabel as nib
 from Utils import formatScanName
+from SliceIndex import SliceIndex
 
 
 class LabelGenerator:    
     def __init__(self):
         self.folder = "../Data/CombinedData/"
         self.labelPath = "Inputs/BadVolumes.csv"
+        #optional central label database written by the viewer, used instead of labelPath when set
+        self.databasePath = None
         self.maxValPath = "Inputs/maxVals.pickle"
         self.sliceStart = 96
         self.sliceEnd = 160
         self.niiFiles = list()
         self.sNames = dict()
         
-        self.idList = list()
-        self.labels = dict()
+        self.sliceIndex = None
+        self.idList = None
+        self.labels = None
         self.maxVals = None
     
     def generateLabels(self):
@@ -30,7 +36,51 @@ class LabelGenerator:
                     self.sNames[filePath] = formatScanName(file)
 
         #dict of bad volumes based on scan name
-        print("Getting bad volumes from csv")
+        if self.databasePath is not None:
+            print("Getting bad volumes from database")
+            badVols = self.readBadVolumesFromDatabase()
+        else:
+            print("Getting bad volumes from csv")
+            badVols = self.readBadVolumesFromCsv()
+
+        print("Generating slice ids and labels")
+        #ID format: (filepath, volume, direction, slice number), stored as columns in a SliceIndex
+        sliceNums = np.arange(self.sliceStart, self.sliceEnd, dtype=np.int32)
+        #64 slices centered around the middle assuming size 255, sagittal (1) and coronal (2) for each
+        slicesPerVolume = 2*len(sliceNums)
+        numVols = [nib.load(file).shape[3] for file in self.niiFiles]
+        
+        columns = {'fileIds': list(), 'volumes': list(), 'planes': list(), 'slices': list(), 'labels': list()}
+        for fileId, file in enumerate(self.niiFiles):
+            volNums = np.arange(numVols[fileId], dtype=np.int32)
+            volLabels = np.isin(volNums, badVols.get(self.sNames[file], [])).astype(np.uint8)
+            columns['fileIds'].append(np.full(numVols[fileId]*slicesPerVolume, fileId, np.int32))
+            columns['volumes'].append(np.repeat(volNums, slicesPerVolume))
+            columns['planes'].append(np.tile(np.array([1, 2], np.uint8), numVols[fileId]*len(sliceNums)))
+            columns['slices'].append(np.tile(np.repeat(sliceNums, 2), numVols[fileId]))
+            columns['labels'].append(np.repeat(volLabels, slicesPerVolume))
+        columns = {name: np.concatenate(arrays) if arrays else np.zeros(0) for name, arrays in columns.items()}
+
+        print("Getting max values from pickle file")
+        
+        with open (self.maxValPath, "rb") as f:
+            scanMaxVals = pickle.load(f)
+        ##max vals pickle file takes sname, vol. the index stores them per file, per volume
+        volumeOffsets = np.concatenate([[0], np.cumsum(numVols)]).astype(np.int64)
+        volumeMax = np.full(volumeOffsets[-1], np.nan, np.float32)
+        for fileId, file in enumerate(self.niiFiles):
+            for vol in range(numVols[fileId]):
+                volumeMax[volumeOffsets[fileId] + vol] = scanMaxVals.get((self.sNames[file], vol), np.nan)
+        
+        self.sliceIndex = SliceIndex(self.niiFiles, volumeOffsets=volumeOffsets, volumeMax=volumeMax, **columns)
+        print("Done")
+
+        ##use sliceIndex (or idList, labels, and maxVals) for machine learning part
+
+    def saveSliceIndex(self, path):
+        self.sliceIndex.save(path)
+
+    def readBadVolumesFromCsv(self):
         badVols = dict()
         with open(self.labelPath) as f:
             lines = f.readlines()
@@ -42,51 +92,40 @@ class LabelGenerator:
                 vols = [int(vol)-1 for vol in vols if vol != '']
                 sName = formatScanName(line[0])
                 badVols[sName] = vols
+        return badVols
 
-        print("Generating slice ids and labels")
-        #ID format: (filepath, volume, direction, slice number)
-        
-        for file in self.niiFiles:
-            sName = self.sNames[file]
-            nii = nib.load(file)
-            for volNum in range(nii.shape[3]):
-                label = 0
-                if sName in badVols:
-                    if volNum in badVols[sName]:
-                        label = 1
-                #64 slices centered around the middle assuming size 255
-                for sliceNum in range(self.sliceStart,self.sliceEnd):
-                    #sagittal
-                    tempId = (file, volNum, 1, sliceNum)
-                    self.idList.append(tempId)
-                    self.labels[tempId] = label
-                    #coronal
-                    tempId = (file, volNum, 2, sliceNum)
-                    self.idList.append(tempId)
-                    self.labels[tempId] = label
-
-        print("Getting max values from pickle file")
-        
-        with open (self.maxValPath, "rb") as f:
-            self.maxVals = pickle.load(f)
-        for file in self.niiFiles:
-            nii = nib.load(file)
-            for vol in range(nii.shape[3]):
-                ##max vals pickle file takes sname, vol. data gen takes filepath, vol
-                self.maxVals[file, vol] = self.maxVals.pop((self.sNames[file], vol))
-        print("Done")
-
-        ##use idList, labels, and maxVals for machine learning part
+    def readBadVolumesFromDatabase(self):
+        #volumes in the database are already 0 indexed
+        badVols = dict()
+        connection = sqlite3.connect(self.databasePath)
+        try:
+            rows = connection.execute('SELECT s.name, e.volume FROM exclusions e JOIN scans s USING (scan_id)')
+            for name, vol in rows:
+                badVols.setdefault(formatScanName(name), list()).append(vol)
+        finally:
+            connection.close()
+        return badVols
     
+    def get_sliceIndex(self):
+        return self.sliceIndex
     def get_idList(self):
+        #list of ID tuples, built on first use from the slice index
+        if self.idList is None:
+            self.idList = self.sliceIndex.getIds(np.arange(len(self.sliceIndex)))
         return self.idList
     def get_labels(self):
+        if self.labels is None:
+            self.labels = self.sliceIndex.getLabelDict()
         return self.labels
     def get_maxVals(self):
+        if self.maxVals is None:
+            self.maxVals = self.sliceIndex.getMaxVals()
         return self.maxVals
     def get_niiFiles(self):
         return self.niiFiles
     def setSliceStart(self, sStart):
         self.sliceStart = sStart
     def setSliceEnd(self, sEnd):
-        self.sliceEnd = sEnd
\ No newline at end of file
+        self.sliceEnd = sEnd
+    def setDatabasePath(self, dbPath):
+        self.databasePath = dbPath
\ No newline at end of file
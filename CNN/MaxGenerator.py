@@ -1,36 +1,123 @@
 '''
-Pulls the maximum value of each volume for each nii file and puts it into the
-maxVals.pickle file
+Computes per-volume statistics (max, mean, percentiles) of each nii file and keeps them in the
+Inputs/volumeStats.pickle store. Files already in the store are skipped unless they changed, so adding
+scans only processes the new ones. The max of every volume is also written to Inputs/maxVals.pickle
 '''
 from Utils import formatScanName
 import os
+import hashlib
+import multiprocessing
 import nibabel as nib
 import numpy as np
 import pickle
 
 folders = ["../Data/CombinedData"]
-niiFiles = list()
-sNames = dict()
-for folder in folders:
-    for dirpaths, dirs, files in os.walk(folder):
-        for file in files:
-            if file.endswith('.nii'):
-                filePath = os.path.join(dirpaths, file)
-                niiFiles.append(filePath)
-                sNames[filePath] = formatScanName(file)
-            
-maxVals = dict()
-count = 0
-for file in niiFiles:
-    count+=1
-    sName = sNames[file]
-    print(file, sName, count)
-    nii = nib.load(file)
-    data = nii.get_fdata()
-    for vol in range(data.shape[3]):
-        maxVal = np.max(data[:,:,:,vol])
-        maxVals[sName, vol] = maxVal
-#%%
-with open('Inputs/maxVals.pickle', 'wb+') as f:
-    pickle.dump(maxVals, f)
-print("Complete")
\ No newline at end of file
+statsPath = 'Inputs/volumeStats.pickle'
+maxValsPath = 'Inputs/maxVals.pickle'
+percentiles = [50, 90, 99]
+#number of worker processes reading nii files
+numWorkers = os.cpu_count()
+#compare file content hashes when the modification time changed, skips files that were only touched
+useHash = False
+
+
+def fileHash(filePath):
+    md5 = hashlib.md5()
+    with open(filePath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def volumeStats(filePath):
+    """Reads a nii file once, volume by volume, returns a dict of per-volume stats arrays.
+    Voxels are read memory-mapped in the on-disk dtype; the scaling of the header is applied to the stats"""
+    nii = nib.load(filePath)
+    data = nii.dataobj.get_unscaled()
+    slope = nii.dataobj.slope
+    inter = nii.dataobj.inter
+    numVols = data.shape[3]
+
+    stats = {'max': np.zeros(numVols), 'min': np.zeros(numVols), 'mean': np.zeros(numVols),
+             'percentiles': np.zeros((numVols, len(percentiles)))}
+    for vol in range(numVols):
+        volume = np.asarray(data[:,:,:,vol])
+        stats['max'][vol] = volume.max()
+        stats['min'][vol] = volume.min()
+        stats['mean'][vol] = volume.mean(dtype=np.float64)
+        stats['percentiles'][vol] = np.percentile(volume, percentiles)
+
+    for name in ('max', 'min', 'mean', 'percentiles'):
+        stats[name] = stats[name]*slope + inter
+    if slope < 0:
+        stats['max'], stats['min'] = stats['min'], stats['max']
+        stats['percentiles'] = stats['percentiles'][:, ::-1]
+    return stats
+
+
+def processFile(args):
+    """Worker: returns (scan name, store entry) for a nii file"""
+    filePath, sName = args
+    status = os.stat(filePath)
+    entry = {'path': filePath, 'mtime': status.st_mtime, 'size': status.st_size, 'percentiles': percentiles}
+    if useHash:
+        entry['hash'] = fileHash(filePath)
+    entry['stats'] = volumeStats(filePath)
+    return sName, entry
+
+
+def isUnchanged(filePath, entry):
+    """True if the store entry of a file is up to date"""
+    if entry is None or entry.get('percentiles') != percentiles:
+        return False
+    status = os.stat(filePath)
+    if entry['mtime'] == status.st_mtime and entry['size'] == status.st_size:
+        return True
+    if useHash and entry.get('hash') is not None and entry['size'] == status.st_size:
+        if entry['hash'] == fileHash(filePath):
+            entry['mtime'] = status.st_mtime
+            return True
+    return False
+
+
+def main():
+    niiFiles = list()
+    sNames = dict()
+    for folder in folders:
+        for dirpaths, dirs, files in os.walk(folder):
+            for file in files:
+                if file.endswith('.nii'):
+                    filePath = os.path.join(dirpaths, file)
+                    niiFiles.append(filePath)
+                    sNames[filePath] = formatScanName(file)
+
+    store = dict()
+    if os.path.exists(statsPath):
+        with open(statsPath, 'rb') as f:
+            store = pickle.load(f)
+
+    todo = [(file, sNames[file]) for file in niiFiles if not isUnchanged(file, store.get(sNames[file]))]
+    print(len(niiFiles) - len(todo), "files unchanged,", len(todo), "files to process")
+
+    count = 0
+    with multiprocessing.Pool(max(1, numWorkers)) as pool:
+        for sName, entry in pool.imap_unordered(processFile, todo):
+            count += 1
+            print(entry['path'], sName, count)
+            store[sName] = entry
+
+    with open(statsPath, 'wb+') as f:
+        pickle.dump(store, f)
+
+    #max of every volume keyed by (scan name, volume), read by LabelGenerator
+    maxVals = dict()
+    for sName, entry in store.items():
+        for vol, maxVal in enumerate(entry['stats']['max']):
+            maxVals[sName, vol] = maxVal
+    with open(maxValsPath, 'wb+') as f:
+        pickle.dump(maxVals, f)
+    print("Complete")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 import numpy as np
-from keras.models import load_model
 from sklearn.metrics import f1_score, accuracy_score, recall_score, precision_score, confusion_matrix
 import seaborn as sn
 import pandas as pd
 import matplotlib.pyplot as plt
+from ArrayDataset import loadArrays
+from Evaluation import cachedPredictions, thresholdSweep, rocCurve, prCurve
 
 #%%
 def calcScores(y, pred):
@@ -21,29 +22,26 @@ def calcScores(y, pred):
 #%%
 print("Loading data...")
 prefix = "DataArrays/400000/"
-X_train = np.load(prefix + "dataxtrain.npy")
-X_test = np.load(prefix + "dataxtest.npy")
-y_train = np.load(prefix + "dataytrain.npy")
-y_test = np.load(prefix + "dataytest.npy")
-
-y_train = y_train[:,1]
-y_test = y_test[:,1]
+#memory-mapped, slices are paged in from disk as batches are read so datasets larger than RAM work
+#scale dequantizes uint8/float16 slices to float32 batch by batch
+X_train, X_test, y_train, y_test, scale = loadArrays(prefix)
 print("Loaded")
 
 #%%
-
-model = load_model('models/model_v4.h5')
+modelPath = 'models/model_v4.h5'
+#probabilities are cached in ScoreCache/ per model and dataset, change threshold below without re-running inference
+threshold = 0.5
 
 #%%
 print("Predicting Train Set...")
-prob_train = model.predict(X_train)
+prob_train = cachedPredictions(modelPath, X_train, prefix + "dataxtrain.npy", scale)
 #%%
 print("Predicting Test Set...")
-prob_test = model.predict(X_test)
+prob_test = cachedPredictions(modelPath, X_test, prefix + "dataxtest.npy", scale)
 print("Done predictions")
 #%%
-pred_train = [1 if prob > 0.5 else 0 for prob in prob_train]
-pred_test = [1 if prob > 0.5 else 0 for prob in prob_test]
+pred_train = (prob_train > threshold).astype(int)
+pred_test = (prob_test > threshold).astype(int)
 
 #%%
 print("Train Scores")
@@ -83,4 +81,32 @@ ax2.set_xlabel("Predicted")
 ax2.set_ylabel("True")
 fig.suptitle('Confusion Matrices', fontsize=16)
 plt.savefig('ConfusionMatrices.png')
-fig.show()
\ No newline at end of file
+fig.show()
+
+#%%
+##Threshold sweep on the test set
+sweep = thresholdSweep(y_test, prob_test, np.linspace(0, 1, 101))
+sweepDf = pd.DataFrame(sweep).set_index('threshold')
+print(sweepDf.iloc[::10].to_string(float_format='%0.4f'))
+sweepDf.to_csv('ThresholdSweep.csv')
+
+fpr_train, tpr_train, auc_train = rocCurve(y_train, prob_train)
+fpr_test, tpr_test, auc_test = rocCurve(y_test, prob_test)
+recall_train, precision_train, ap_train = prCurve(y_train, prob_train)
+recall_test, precision_test, ap_test = prCurve(y_test, prob_test)
+
+fig, (ax1,ax2) = plt.subplots(ncols=2, figsize=(10, 4))
+ax1.plot(fpr_train, tpr_train, label="Train (AUC %0.4f)" % auc_train)
+ax1.plot(fpr_test, tpr_test, label="Test (AUC %0.4f)" % auc_test)
+ax1.set_title("ROC")
+ax1.set_xlabel("False Positive Rate")
+ax1.set_ylabel("True Positive Rate")
+ax1.legend()
+ax2.plot(recall_train, precision_train, label="Train (AP %0.4f)" % ap_train)
+ax2.plot(recall_test, precision_test, label="Test (AP %0.4f)" % ap_test)
+ax2.set_title("Precision-Recall")
+ax2.set_xlabel("Recall")
+ax2.set_ylabel("Precision")
+ax2.legend()
+plt.savefig('ThresholdCurves.png')
+fig.show()
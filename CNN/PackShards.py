@@ -0,0 +1,53 @@
+'''
+Packs normalized, resized slices into a sharded dataset, run once before training with ShardReader
+Train and test sets are split by nii file and written to separate dataset folders
+'''
+import os
+import numpy as np
+from LabelGenerator import LabelGenerator
+from SliceIndex import SliceIndex
+from ShardedDataset import packShards
+
+outputPath = "DataShards/"
+#slices per shard file
+shardSize = 4096
+#storage type of the slices: 'uint8', 'float16' or 'float32'
+storage = 'uint8'
+#compress shard files, smaller on disk but slower to read
+compress = False
+#crop slices to each scan's brain bounding box before resizing, the viewer must then detect with detectCrop
+crop = False
+#Train test split
+trainTestSplit = 0.2
+#allowable distance from the middle of the volume to select slices from
+gap = 50
+seed = 1
+numWorkers = os.cpu_count()
+#slice index saved by an earlier run, set to None to generate it from the nii files and label csv
+sliceIndexPath = None
+
+#%%
+if sliceIndexPath is not None:
+    sliceIndex = SliceIndex.load(sliceIndexPath)
+else:
+    labelGenerator = LabelGenerator()
+    labelGenerator.setSliceStart(128-gap)
+    labelGenerator.setSliceEnd(128+gap)
+    labelGenerator.generateLabels()
+    sliceIndex = labelGenerator.get_sliceIndex()
+
+print(len(sliceIndex), "slices to pack")
+
+#%%
+##Train Test Split by nii file
+rng = np.random.RandomState(seed)
+testFiles = rng.permutation(len(sliceIndex.files))[:int(trainTestSplit*len(sliceIndex.files))]
+isTest = np.isin(sliceIndex.fileIds, testFiles)
+
+print("Packing train set")
+packShards(sliceIndex, np.flatnonzero(~isTest), outputPath + "train", shardSize, storage=storage,
+           compress=compress, seed=seed, numWorkers=numWorkers, crop=crop)
+print("Packing test set")
+packShards(sliceIndex, np.flatnonzero(isTest), outputPath + "test", shardSize, storage=storage,
+           compress=compress, seed=seed, numWorkers=numWorkers, crop=crop)
+print("Done")
@@ -0,0 +1,38 @@
+'''
+Reduced-precision storage of slices normalized to [0, 1]
+'''
+import numpy as np
+
+#storage dtype name: (numpy dtype, scale), stored value * scale = normalized value
+STORAGE_TYPES = {'float32': (np.float32, 1.0),
+                 'float16': (np.float16, 1.0),
+                 'uint8': (np.uint8, 1.0/255)}
+
+
+def storageDtype(name):
+    return STORAGE_TYPES[name][0]
+
+
+def storageScale(name):
+    return STORAGE_TYPES[name][1]
+
+
+def quantize(x, name, out=None):
+    """Converts normalized slices to the storage dtype, uint8 values are rounded to steps of 1/255"""
+    dtype, scale = STORAGE_TYPES[name]
+    if np.issubdtype(dtype, np.integer):
+        q = np.rint(np.clip(x, 0, 1) / scale)
+    else:
+        q = x
+    if out is None:
+        return np.asarray(q, dtype)
+    out[...] = q
+    return out
+
+
+def dequantize(q, scale, out=None):
+    """Converts stored slices back to float32 normalized values"""
+    if out is None:
+        out = np.empty(q.shape, np.float32)
+    np.multiply(q, np.float32(scale), out=out, casting='unsafe')
+    return out
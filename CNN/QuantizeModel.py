@@ -0,0 +1,87 @@
+'''
+Post-training quantization of the detection model for CPU inference in the viewer.
+Converts the keras model to TensorFlow Lite with int8 weights and activations, calibrated on a sample of
+undersampled training slices, and with float16 weights. Reports file size, inference time and the change in the
+ModelAnalysis metrics on a sample of test slices for each converted model.
+Run the viewer with a converted model by setting BRAINZ_DETECTOR_MODEL to its path, or set modelPath in
+ModelAnalysis.py to it for the full analysis
+'''
+import os
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from ArrayDataset import loadArrays
+from Quantization import dequantize
+from Evaluation import getModel, classificationScores, timeVolumePredictions
+
+prefix = "DataArrays/400000/"
+modelPath = 'models/model_v4.h5'
+quantizations = ['int8', 'float16']
+#training slices the int8 activation ranges are calibrated on
+numCalibration = 500
+#test slices the accuracy is compared on
+numSlices = 20000
+#the viewer predicts the 20 sampled slices of a volume at a time
+volumeBatch = 20
+numTimedVolumes = 50
+threshold = 0.5
+seed = 1
+reportPath = 'QuantizationReport.csv'
+
+#%%
+def convert(modelPath, quantization, calibrationSlices):
+    """Converts a keras model file to a .tflite model next to it and returns the new path"""
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(modelPath)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        def representativeDataset():
+            for i in range(len(calibrationSlices)):
+                yield [calibrationSlices[i:i+1]]
+        #every op in int8, inputs and outputs stay float32 so the viewer's preprocessing is unchanged
+        converter.representative_dataset = representativeDataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization == 'float16':
+        converter.target_spec.supported_types = [tf.lite.constants.FLOAT16]
+    else:
+        raise ValueError("Unknown quantization " + quantization)
+
+    outputPath = os.path.splitext(modelPath)[0] + '_' + quantization + '.tflite'
+    with open(outputPath, 'wb') as f:
+        f.write(converter.convert())
+    return outputPath
+
+
+#%%
+X_train, X_test, y_train, y_test, scale = loadArrays(prefix)
+random = np.random.RandomState(seed)
+calibrationRows = np.sort(random.choice(len(X_train), min(numCalibration, len(X_train)), replace=False))
+calibrationSlices = dequantize(X_train[calibrationRows], scale)
+rows = np.sort(random.choice(len(X_test), min(numSlices, len(X_test)), replace=False))
+X = dequantize(X_test[rows], scale)
+y = np.asarray(y_test[rows])
+
+#%%
+report = list()
+reference = None
+for path in [modelPath] + [convert(modelPath, quantization, calibrationSlices) for quantization in quantizations]:
+    print("Evaluating", path)
+    model = getModel(path)
+    prob = np.concatenate([model.predict(X[start:start+256]) for start in range(0, len(X), 256)])[:,0]
+    if reference is None:
+        reference = prob
+    row = {'model': os.path.basename(path),
+           'size MB': os.path.getsize(path) / 2**20,
+           'ms per volume': timeVolumePredictions(model, X, volumeBatch, numTimedVolumes)}
+    row.update(classificationScores(y, prob, threshold))
+    row['max probability change'] = np.max(np.abs(prob - reference))
+    row['flipped'] = np.sum((prob > threshold) != (reference > threshold))
+    report.append(row)
+
+reportDf = pd.DataFrame(report).set_index('model')
+for metric in ['accuracy', 'recall', 'precision', 'f1', 'auc']:
+    reportDf[metric + ' delta'] = reportDf[metric] - reportDf[metric].iloc[0]
+reportDf['speedup'] = reportDf['ms per volume'].iloc[0] / reportDf['ms per volume']
+reportDf['size ratio'] = reportDf['size MB'] / reportDf['size MB'].iloc[0]
+print(reportDf.to_string(float_format='%0.4f'))
+reportDf.to_csv(reportPath)
+print("Saved report to", reportPath)
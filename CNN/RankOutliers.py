@@ -0,0 +1,36 @@
+'''
+Ranks the volumes of every scan by how far they deviate from the other volumes of their b-value shell
+(inter-volume correlation of downsampled volumes, see the viewer's Similarity.py), without running the CNN.
+Writes one row per volume to a csv, volumes are 1-indexed like the bad volume csv files
+'''
+import csv
+import glob
+import os
+import sys
+import time
+import nibabel as nib
+
+#share the triage code with the viewer
+sys.path.append('../Viewer/src/main/python/brAInzViewer')
+from Similarity import OUTLIER_THRESHOLD, scanOutliers
+
+dataPath = "../Data/"
+outputPath = "Inputs/outlierRanking.csv"
+
+#%%
+niiPaths = sorted(glob.glob(os.path.join(dataPath, '*.nii')) + glob.glob(os.path.join(dataPath, '*.nii.gz')))
+with open(outputPath, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['Scan', 'Volume', 'b-value', 'Score', 'Rank'])
+    for niiPath in niiPaths:
+        start = time.time()
+        #volumes are read one at a time from the file
+        scores, ranking, bval = scanOutliers(niiPath, nib.load(niiPath).dataobj)
+        if bval is not None and len(bval) != len(scores):
+            bval = None  #ignored for shells too, see Similarity.shellGroups
+        for rank, v in enumerate(ranking):
+            writer.writerow([os.path.basename(niiPath), v + 1, '' if bval is None else bval[v],
+                             '%0.2f' % scores[v], rank + 1])
+        outliers = [v + 1 for v in ranking if scores[v] > OUTLIER_THRESHOLD]
+        print(os.path.basename(niiPath), "%0.2fs," % (time.time() - start), "outlier volumes:", outliers)
+print("Saved ranking to", outputPath)
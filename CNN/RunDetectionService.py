@@ -0,0 +1,47 @@
+'''
+Serves the detection model on localhost so every viewer and batch tool on the machine shares one loaded, warm model.
+Concurrent requests are merged into larger batches, waiting at most maxLatency milliseconds for more requests.
+Point BRAINZ_DETECTOR_MODEL (viewer) or modelPath (CalibrateDetection.py, BenchmarkCascade.py) at the printed url.
+Queue depth and throughput are printed every metricsInterval seconds and served as json on <url>/metrics
+'''
+import sys
+import threading
+import time
+import numpy as np
+
+#share detection code with the viewer
+sys.path.append('../Viewer/src/main/python/brAInzViewer')
+from MachineLearning import MotionDetector
+from DetectionService import DetectionServer, DEFAULT_PORT, MAX_LATENCY_MS, MAX_BATCH
+
+#keras .h5 or .tflite model
+modelPath = "models/model_v4.h5"
+port = DEFAULT_PORT
+maxLatency = MAX_LATENCY_MS
+maxBatch = MAX_BATCH
+#slice size of the model's input, used for a warm-up prediction
+detectResizeDimension = (128, 128)
+#seconds between metrics printouts, None for none
+metricsInterval = 60
+
+
+def printMetrics(server):
+    while True:
+        time.sleep(metricsInterval)
+        metrics = server.predictor.metrics()
+        print("queue {queueDepth}, {requests} requests, {slices} slices in {batches} batches "
+              "(mean {meanBatchSize:.1f}), wait {meanWaitMs:.1f} ms, predict {meanPredictMs:.1f} ms, "
+              "{slicesPerSecond:.1f} slices/s, {failed} failed".format(**metrics))
+
+
+#%%
+motionDetector = MotionDetector()
+motionDetector.setModel(modelPath, None, detectResizeDimension)
+#the first prediction builds the model's graph, done here so no client waits for it
+motionDetector.predictSlices(np.zeros((1, detectResizeDimension[0], detectResizeDimension[1], 1)))
+
+server = DetectionServer(motionDetector.predictSlices, port, maxLatency, maxBatch)
+if metricsInterval is not None:
+    threading.Thread(target=printMetrics, args=(server,), daemon=True).start()
+print("Serving", modelPath, "on http://127.0.0.1:%d" % port)
+server.serve_forever()
@@ -0,0 +1,131 @@
+'''
+Sharded slice dataset: resized and normalized slices packed once into fixed-size shard files plus an index.json,
+read back shard by shard so every epoch is a sequential streaming read
+'''
+import json
+import os
+import time
+import numpy as np
+import keras
+from DataGeneratorSimple import DataGenerator
+from Quantization import quantize, dequantize, storageScale
+from SliceExtraction import poolContext
+
+INDEX_FILE = 'index.json'
+
+
+def packShard(args):
+    """Worker: pulls the slices of one shard and writes them to a shard file"""
+    shardPath, ids, labels, maxVals, dim, storage, compress, crop = args
+    dataGen = DataGenerator(ids, labels={}, max_brightness=maxVals, dim=dim, n_classes=2, shuffle=False, crop=crop)
+    X = np.empty((len(ids), dim[0], dim[1], 1), np.float32)
+    for index, img in dataGen.load_nii_slices(ids):
+        X[index,:,:,0] = img
+
+    columns = {'X': quantize(X, storage), 'y': np.asarray(labels, np.uint8),
+               'volumes': np.array([i[1] for i in ids], np.int32), 'planes': np.array([i[2] for i in ids], np.uint8),
+               'slices': np.array([i[3] for i in ids], np.int32), 'files': np.array([i[0] for i in ids])}
+    if compress:
+        np.savez_compressed(shardPath, **columns)
+    else:
+        np.savez(shardPath, **columns)
+    return os.path.basename(shardPath), len(ids), int(np.sum(labels))
+
+
+def packShards(sliceIndex, indices, outputDir, shardSize=4096, dim=(128,128), storage='uint8', compress=False,
+               seed=1, numWorkers=1, crop=False):
+    """Packs the slices sliceIndex[indices] into shard files of shardSize slices in outputDir.
+    Slices are shuffled across shards with seed before packing, storage is a Quantization storage type,
+    crop crops slices to the brain bounding box"""
+    os.makedirs(outputDir, exist_ok=True)
+    order = np.random.RandomState(seed).permutation(np.asarray(indices))
+    maxVals = sliceIndex.getMaxVals()
+
+    jobs = list()
+    for shardNum, start in enumerate(range(0, len(order), shardSize)):
+        shardIndices = order[start:start + shardSize]
+        ids = sliceIndex.getIds(shardIndices)
+        shardMaxVals = {key: maxVals[key] for key in set(i[:2] for i in ids) if key in maxVals}
+        jobs.append((os.path.join(outputDir, 'shard_{:05d}.npz'.format(shardNum)), ids,
+                     sliceIndex.labels[shardIndices], shardMaxVals, dim, storage, compress, crop))
+
+    shards = dict()
+    start = time.time()
+    done = 0
+    with poolContext().Pool(max(1, numWorkers)) as pool:
+        for fileName, count, positives in pool.imap_unordered(packShard, jobs):
+            shards[fileName] = {'file': fileName, 'count': count, 'positives': positives}
+            done += count
+            print(done, "of", len(order), "slices packed,", int(done / max(time.time() - start, 1e-9)), "slices/s")
+
+    index = {'dim': list(dim), 'storage': storage, 'scale': storageScale(storage), 'compressed': compress,
+             'crop': crop,
+             'shards': [shards[name] for name in sorted(shards)]}
+    with open(os.path.join(outputDir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+class ShardReader(keras.utils.Sequence):
+    """Reads a packed dataset batch by batch. Shards are visited in (optionally shuffled) order and read whole, one
+    at a time, then batched from memory, so disk access is sequential. Slices are dequantized to float32 on the fly.
+    Batches do not span shards, the remainder of each shard that does not fill a batch is skipped for the epoch.
+    Batches must be requested in order, pass shuffle=False to fit_generator: the reader shuffles shards and slices
+    itself at the end of every epoch, and out of order requests reload a whole shard for every batch"""
+    def __init__(self, datasetDir, batch_size=32, shuffle=True, one_hot=False, n_classes=2):
+        with open(os.path.join(datasetDir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.datasetDir = datasetDir
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.one_hot = one_hot
+        self.n_classes = n_classes
+        self.scale = self.index['scale']
+        self.shards = self.index['shards']
+        self.loadedShard = None
+        self.loaded = None
+        self.lastIndex = None
+        self.warned = False
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(self.batchOffsets[-1])
+
+    def on_epoch_end(self):
+        'Shuffles the shard order and the slice order within shards'
+        self.shardOrder = np.arange(len(self.shards))
+        if self.shuffle:
+            np.random.shuffle(self.shardOrder)
+        counts = [self.shards[s]['count'] // self.batch_size for s in self.shardOrder]
+        self.batchOffsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        #one slice order per shard for the whole epoch, so reloading a shard serves the same batches
+        self.orders = [np.random.permutation(shard['count']) if self.shuffle else np.arange(shard['count'])
+                       for shard in self.shards]
+        self.loadedShard = None
+        self.loaded = None
+        self.lastIndex = None
+
+    def loadShard(self, shardNum):
+        if self.loadedShard != shardNum:
+            with np.load(os.path.join(self.datasetDir, self.shards[shardNum]['file'])) as data:
+                X = data['X']
+                y = data['y']
+            self.loaded = (X, y, self.orders[shardNum])
+            self.loadedShard = shardNum
+        return self.loaded
+
+    def __getitem__(self, index):
+        if self.lastIndex is not None and index != self.lastIndex + 1 and not self.warned:
+            print("WARNING: ShardReader batches requested out of order, use fit_generator(shuffle=False)")
+            self.warned = True
+        self.lastIndex = index
+        position = int(np.searchsorted(self.batchOffsets, index, side='right') - 1)
+        X, y, order = self.loadShard(self.shardOrder[position])
+        batchNum = index - self.batchOffsets[position]
+        rows = np.sort(order[batchNum*self.batch_size:(batchNum+1)*self.batch_size])
+
+        X_batch = dequantize(X[rows], self.scale)
+        y_batch = y[rows]
+        if self.one_hot:
+            return X_batch, keras.utils.to_categorical(y_batch, num_classes=self.n_classes)
+        return X_batch, y_batch.astype(np.float32)
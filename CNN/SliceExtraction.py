@@ -0,0 +1,77 @@
+'''
+Pulls resized and normalized slices out of nii files into memory-mapped npy arrays,
+optionally sharded by nii file across a pool of worker processes
+'''
+import multiprocessing
+import time
+import numpy as np
+from DataGeneratorSimple import DataGenerator
+from Quantization import quantize
+
+
+def poolContext():
+    """Multiprocessing context for worker pools started from the training scripts.
+    fork lets workers inherit the already imported modules and does not re-run the calling script"""
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def shardByFile(sampleIds, destinations, maxVals):
+    """Groups samples by nii file, returns a list of (ids, destinations, maxVals) with one entry per file.
+    Destinations are (array name, index) pairs, worked out before sharding so the output does not depend on
+    how shards are scheduled"""
+    shards = dict()
+    for sampleId, destination in zip(sampleIds, destinations):
+        ids, dests = shards.setdefault(sampleId[0], (list(), list()))
+        ids.append(sampleId)
+        dests.append(destination)
+
+    shardList = list()
+    for filePath in sorted(shards):
+        ids, dests = shards[filePath]
+        shardMaxVals = {(path, vol): maxVals[path, vol] for path, vol in set(i[:2] for i in ids)
+                        if (path, vol) in maxVals}
+        shardList.append((ids, dests, shardMaxVals))
+    return shardList
+
+
+def extractShard(args):
+    """Worker: writes the slices of one shard straight into the memory-mapped output arrays"""
+    ids, dests, maxVals, outputPaths, dim, storage, crop = args
+    dataGen = DataGenerator(ids, labels={}, max_brightness=maxVals, dim=dim, n_classes=2, shuffle=False, crop=crop)
+    arrays = {name: np.load(path, mmap_mode='r+') for name, path in outputPaths.items()}
+    for index, img in dataGen.load_nii_slices(ids):
+        name, arrayIndex = dests[index]
+        quantize(img, storage, out=arrays[name][arrayIndex,:,:,0])
+    for array in arrays.values():
+        array.flush()
+    return len(ids)
+
+
+def extractSlices(sampleIds, destinations, maxVals, outputPaths, dim, numWorkers=1, storage='float32', crop=False):
+    """Fills the npy files in outputPaths (dict of array name: path, already allocated with open_memmap)
+    with the slices of sampleIds. destinations[i] is the (array name, index) sampleIds[i] is written to.
+    Runs in this process when numWorkers is 1, otherwise shards the work by nii file across numWorkers processes.
+    storage is the Quantization storage type the arrays were allocated with, crop crops slices to the brain box"""
+    shards = [(ids, dests, shardMaxVals, outputPaths, dim, storage, crop)
+              for ids, dests, shardMaxVals in shardByFile(sampleIds, destinations, maxVals)]
+    total = len(sampleIds)
+    start = time.time()
+    done = 0
+
+    def report(count):
+        elapsed = max(time.time() - start, 1e-9)
+        print(count, "of", total, "slices pulled,", int(count / elapsed), "slices/s")
+
+    if numWorkers <= 1:
+        for shard in shards:
+            done += extractShard(shard)
+            report(done)
+        return done
+
+    with poolContext().Pool(numWorkers) as pool:
+        for count in pool.imap_unordered(extractShard, shards):
+            done += count
+            report(done)
+    return done
@@ -0,0 +1,61 @@
+'''
+Columnar index of slice IDs and labels, replaces lists of (file_path, volume, direction, slice number) tuples
+'''
+import numpy as np
+
+
+class SliceIndex:
+    """Slice IDs stored as columns: a table of nii file paths plus one int array entry per slice.
+    Max voxel values are kept per volume, volumeMax[volumeOffsets[f] + v] is the max of volume v of file f"""
+    def __init__(self, files, fileIds, volumes, planes, slices, labels, volumeOffsets, volumeMax):
+        self.files = list(files)
+        self.fileIds = np.asarray(fileIds, np.int32)
+        self.volumes = np.asarray(volumes, np.int32)
+        self.planes = np.asarray(planes, np.uint8)
+        self.slices = np.asarray(slices, np.int32)
+        self.labels = np.asarray(labels, np.uint8)
+        self.volumeOffsets = np.asarray(volumeOffsets, np.int64)
+        self.volumeMax = np.asarray(volumeMax, np.float32)
+
+    def __len__(self):
+        return len(self.fileIds)
+
+    def getId(self, i):
+        """Returns the (file_path, volume, direction, slice number) tuple of slice i"""
+        return (self.files[self.fileIds[i]], int(self.volumes[i]), int(self.planes[i]), int(self.slices[i]))
+
+    def getIds(self, indices):
+        """Returns ID tuples for an array of slice indices"""
+        return [(self.files[f], int(v), int(p), int(s)) for f, v, p, s in
+                zip(self.fileIds[indices], self.volumes[indices], self.planes[indices], self.slices[indices])]
+
+    def getLabelDict(self, indices=None):
+        """Returns labels as a dict keyed by ID tuple, the format LabelGenerator.get_labels used"""
+        if indices is None:
+            indices = np.arange(len(self))
+        return dict(zip(self.getIds(indices), self.labels[indices].tolist()))
+
+    def getMaxVals(self):
+        """Returns max voxel values as a dict keyed by (file_path, volume), the format DataGenerator takes"""
+        maxVals = dict()
+        for f, file in enumerate(self.files):
+            start, end = self.volumeOffsets[f], self.volumeOffsets[f + 1]
+            for vol, maxVal in enumerate(self.volumeMax[start:end].tolist()):
+                if not np.isnan(maxVal):
+                    maxVals[file, vol] = maxVal
+        return maxVals
+
+    def subset(self, indices):
+        """Returns a SliceIndex of the selected slices, sharing the file and volume tables"""
+        return SliceIndex(self.files, self.fileIds[indices], self.volumes[indices], self.planes[indices],
+                          self.slices[indices], self.labels[indices], self.volumeOffsets, self.volumeMax)
+
+    def save(self, path):
+        np.savez(path, files=np.array(self.files), fileIds=self.fileIds, volumes=self.volumes, planes=self.planes,
+                 slices=self.slices, labels=self.labels, volumeOffsets=self.volumeOffsets, volumeMax=self.volumeMax)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['files'].tolist(), data['fileIds'], data['volumes'], data['planes'], data['slices'],
+                       data['labels'], data['volumeOffsets'], data['volumeMax'])
@@ -0,0 +1,137 @@
+'''
+Parallel hyperparameter sweep of the TrainInRam.py model on CPU.
+Trials run in worker processes that each train one setting of the search space. Every trial memory-maps the same
+pregenerated arrays, so the dataset is held once in the page cache rather than once per trial, and is pinned to its
+own block of cores with a matching number of TensorFlow threads. Trials whose validation loss falls behind the median
+of the other trials at the same epoch are stopped early. Writes a results table and copies the best checkpoint
+'''
+import itertools
+import os
+import shutil
+import time
+import multiprocessing
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import keras
+from keras.callbacks import ModelCheckpoint, Callback
+from ArrayDataset import loadArrays, ArraySequence
+from Architecture import buildModel
+
+prefix = "DataArrays/400000/"
+searchSpace = {'batchSize': [32, 64],
+               'numGroups': [3, 4],
+               'dropout1': [0.5, 0.7],
+               'dropout2': [0.5, 0.7],
+               'layer_size': [32, 64, 96],
+               'lr': [0.001, 0.008]}
+#random sample of this many settings of the search space, None runs every setting
+numTrials = 16
+numWorkers = 4
+threadsPerTrial = max(1, os.cpu_count() // numWorkers)
+epochs = 20
+#from this epoch on, a trial whose best validation loss is worse than the median of the other trials' best at the
+#same epoch is stopped, once at least minTrialsToPrune other trials got that far
+pruneFromEpoch = 3
+minTrialsToPrune = 3
+outputDir = "Sweep/"
+resultsPath = outputDir + "results.csv"
+bestModelPath = "weights/sweep_best.h5"
+seed = 1
+
+
+class MedianPruning(Callback):
+    """Shares the trial's validation losses with the other trials and stops training when it falls behind them"""
+    def __init__(self, trial, history):
+        super(MedianPruning, self).__init__()
+        self.trial = trial
+        self.history = history
+        self.losses = list()
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.losses.append(logs['val_loss'])
+        #a shared dict only sees assignments, not changes to the lists in it
+        self.history[self.trial] = list(self.losses)
+        if epoch + 1 < pruneFromEpoch:
+            return
+        others = [min(losses[:epoch+1]) for trial, losses in self.history.items()
+                  if trial != self.trial and len(losses) > epoch]
+        if len(others) >= minTrialsToPrune and min(self.losses) > np.median(others):
+            print("Pruning trial", self.trial, "at epoch", epoch + 1)
+            self.pruned = True
+            self.model.stop_training = True
+
+
+def runTrial(args):
+    """Worker: trains one setting on a free block of cores, returns its row of the results table"""
+    trial, params, coreQueue, history = args
+    cores = coreQueue.get()
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        config = tf.ConfigProto(intra_op_parallelism_threads=len(cores), inter_op_parallelism_threads=1)
+        keras.backend.set_session(tf.Session(config=config))
+
+        X_train, X_test, y_train, y_test, scale = loadArrays(prefix)
+        model = buildModel(params['numGroups'], params['layer_size'], params['dropout1'], params['dropout2'],
+                           params['lr'])
+        checkpointPath = os.path.join(outputDir, 'trial{}.h5'.format(trial))
+        pruning = MedianPruning(trial, history)
+        start = time.time()
+        fit = model.fit_generator(ArraySequence(X_train, y_train, params['batchSize'], scale),
+                                  validation_data=ArraySequence(X_test, y_test, params['batchSize'], scale,
+                                                                shuffle=False),
+                                  epochs=epochs, verbose=0,
+                                  callbacks=[ModelCheckpoint(checkpointPath, monitor='val_loss',
+                                                             save_best_only=True), pruning])
+        best = int(np.argmin(fit.history['val_loss']))
+        result = {'trial': trial}
+        result.update(params)
+        result.update({'val_loss': fit.history['val_loss'][best], 'val_acc': fit.history['val_acc'][best],
+                       'best epoch': best + 1, 'epochs': len(fit.history['val_loss']), 'pruned': pruning.pruned,
+                       'minutes': (time.time() - start) / 60, 'checkpoint': checkpointPath})
+        return result
+    finally:
+        coreQueue.put(cores)
+
+
+def main():
+    names = list(searchSpace)
+    settings = list(itertools.product(*(searchSpace[name] for name in names)))
+    if numTrials is not None and numTrials < len(settings):
+        rows = np.random.RandomState(seed).choice(len(settings), numTrials, replace=False)
+        settings = [settings[i] for i in sorted(rows)]
+    print(len(settings), "trials on", numWorkers, "workers of", threadsPerTrial, "threads")
+
+    os.makedirs(outputDir, exist_ok=True)
+    #inherited by the workers, limits the math library's threads to the trial's cores
+    os.environ['OMP_NUM_THREADS'] = str(threadsPerTrial)
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+    #spawn starts every trial with a fresh TensorFlow instead of a fork of this process's
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    coreQueue = manager.Queue()
+    for worker in range(numWorkers):
+        block = cpus[worker*threadsPerTrial:(worker+1)*threadsPerTrial]
+        coreQueue.put(block or cpus)
+    history = manager.dict()
+
+    results = list()
+    tasks = [(trial, dict(zip(names, setting)), coreQueue, history) for trial, setting in enumerate(settings)]
+    with context.Pool(numWorkers, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(runTrial, tasks):
+            results.append(result)
+            print("Trial {trial}: val_loss {val_loss:.4f} val_acc {val_acc:.4f} after {epochs} epochs "
+                  "({minutes:.1f} min){}".format(' pruned' if result['pruned'] else '', **result))
+            pd.DataFrame(results).sort_values('val_loss').to_csv(resultsPath, index=False)
+
+    resultsDf = pd.DataFrame(results).sort_values('val_loss')
+    print(resultsDf.to_string(index=False, float_format='%0.4f'))
+    shutil.copyfile(resultsDf['checkpoint'].iloc[0], bestModelPath)
+    print("Saved results to", resultsPath, "and the best checkpoint to", bestModelPath)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,23 @@
 '''
-Loads datasets to RAM instead of generating data batches on the fly
+Trains from the pregenerated datasets (memory-mapped) instead of generating data batches from nii files on the fly
 '''
-import numpy as np
 import time
-from keras.models import Sequential
-from keras.layers import Dense, Dropout, Activation, Flatten, Conv2D, MaxPooling2D, BatchNormalization
-from keras.optimizers import Adam
 from keras.callbacks import ModelCheckpoint
 from keras.callbacks import TensorBoard
+from ArrayDataset import loadArrays, ArraySequence
+from ShardedDataset import ShardReader
+from Architecture import buildModel
 
 
 #%%
 print("Loading data...")
 prefix = "DataArrays/400000/"
-X_train = np.load(prefix + "dataxtrain.npy")
-X_test = np.load(prefix + "dataxtest.npy")
-y_train = np.load(prefix + "dataytrain.npy")
-y_test = np.load(prefix + "dataytest.npy")
-
-y_train = y_train[:,1]
-y_test = y_test[:,1]
+#memory-mapped, slices are paged in from disk as batches are read so datasets larger than RAM work
+#scale dequantizes uint8/float16 slices to float32 batch by batch
+#set to the PackShards.py output folder to train from packed shards instead, read one shard at a time
+shardPath = None
+if shardPath is None:
+    X_train, X_test, y_train, y_test, scale = loadArrays(prefix)
 print("Loaded")
 #%%
 
@@ -35,40 +33,13 @@ NAME = 'n{}_b{}_da{}_db{}_i{}_{}_{}'.format(numGroups,batchSize,int(dropout1*100
 print(NAME)
 
 print("Setting up model")
-model = Sequential()
 
 tensorboard = TensorBoard(log_dir='logs/{}'.format(NAME))
 checkpoint = ModelCheckpoint('weights/{}.h5'.format(NAME), monitor='val_loss', verbose=0, save_best_only=True, save_weights_only=False, mode='auto', period=1)
 callbacks = [tensorboard, checkpoint]
 
 #### Architecture ####
-model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu", input_shape=(128, 128, 1)))
-model.add(BatchNormalization())
-model.add(MaxPooling2D(pool_size=(3,3)))
-
-for _ in range(numGroups):
-    model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu"))
-    model.add(BatchNormalization())
-    model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu"))
-    model.add(BatchNormalization())
-    model.add(MaxPooling2D(pool_size=(2,2)))
-    model.add(Dropout(dropout1))
-    layer_size *= 2
-    
-model.add(Flatten())
-
-layer_size *= 2
-
-for _ in range(2):
-    model.add(Dense(layer_size, activation='relu'))
-    model.add(BatchNormalization())
-    model.add(Dropout(dropout2))
-
-model.add(Dense(1))
-model.add(Activation('sigmoid'))
-model.compile(loss='binary_crossentropy',
-             optimizer=Adam(lr=0.008),
-             metrics=['accuracy'])
+model = buildModel(numGroups, layer_size, dropout1, dropout2, lr=0.008)
 
 #model.add(Dense(2))
 #model.add(Activation('softmax'))
@@ -78,6 +49,14 @@ model.compile(loss='binary_crossentropy',
 #             metrics=['accuracy'])
 
 # Train model on dataset
-model.fit(X_train, y_train,validation_data=(X_test, y_test), batch_size=batchSize, epochs=100, callbacks = callbacks)
+if shardPath is None:
+    model.fit_generator(ArraySequence(X_train, y_train, batchSize, scale),
+                        validation_data=ArraySequence(X_test, y_test, batchSize, scale, shuffle=False),
+                        epochs=100, callbacks = callbacks)
+else:
+    #the reader shuffles shards and slices itself and needs its batches requested in order
+    model.fit_generator(ShardReader(shardPath + "train", batchSize),
+                        validation_data=ShardReader(shardPath + "test", batchSize, shuffle=False),
+                        epochs=100, callbacks = callbacks, shuffle=False)
 
 #%%
\ No newline at end of file
@@ -0,0 +1,110 @@
+'''
+Knowledge distillation of the detection model into a much smaller student network for faster CPU inference.
+The student is trained on the pregenerated (memory-mapped) arrays against a blend of the teacher's probabilities,
+softened by temperature, and the true labels. Compares the teacher and the best student checkpoint on the test set:
+parameters, file size, milliseconds per volume and the ModelAnalysis metrics.
+Run the viewer with the student by setting BRAINZ_DETECTOR_MODEL to the checkpoint, or by calibrating it with
+CalibrateDetection.py
+'''
+import os
+import time
+import numpy as np
+import pandas as pd
+from keras.models import Sequential
+from keras.layers import Dense, Activation, Conv2D, MaxPooling2D, BatchNormalization, GlobalAveragePooling2D
+from keras.optimizers import Adam
+from keras.callbacks import ModelCheckpoint
+from keras.callbacks import TensorBoard
+from ArrayDataset import loadArrays, ArraySequence
+from Quantization import dequantize
+from Evaluation import getModel, cachedPredictions, classificationScores, timeVolumePredictions
+
+#%%
+print("Loading data...")
+prefix = "DataArrays/400000/"
+X_train, X_test, y_train, y_test, scale = loadArrays(prefix)
+print("Loaded")
+
+teacherPath = 'models/model_v4.h5'
+#weight of the teacher's probabilities in the training targets, the rest is the true label
+alpha = 0.7
+#softens the teacher's probabilities by dividing their logits, 1 uses them as they are
+temperature = 2.0
+batchSize = 64
+epochs = 30
+#the student's first conv layer width, doubled after each of numGroups conv groups
+layer_size = 16
+numGroups = 4
+threshold = 0.5
+#the viewer predicts the 20 sampled slices of a volume at a time
+volumeBatch = 20
+numTimedVolumes = 50
+reportPath = 'DistillationReport.csv'
+
+#%%
+def softenedProbabilities(prob, temperature):
+    logits = np.log(np.clip(prob, 1e-7, 1 - 1e-7) / np.clip(1 - prob, 1e-7, 1))
+    return 1 / (1 + np.exp(-logits / temperature))
+
+#teacher probabilities are cached in ScoreCache/ like ModelAnalysis, so they are only computed once per dataset
+print("Predicting teacher probabilities...")
+teacher_train = cachedPredictions(teacherPath, X_train, prefix + "dataxtrain.npy", scale)
+teacher_test = cachedPredictions(teacherPath, X_test, prefix + "dataxtest.npy", scale)
+targets = (alpha * softenedProbabilities(teacher_train, temperature) + (1 - alpha) * y_train).astype(np.float32)
+
+#%%
+NAME = 'student_n{}_i{}_a{}_t{}_{}'.format(numGroups, layer_size, int(alpha*100), temperature, int(time.time()))
+print(NAME)
+
+tensorboard = TensorBoard(log_dir='logs/{}'.format(NAME))
+checkpoint = ModelCheckpoint('weights/{}.h5'.format(NAME), monitor='val_loss', verbose=0, save_best_only=True,
+                             save_weights_only=False, mode='auto', period=1)
+callbacks = [tensorboard, checkpoint]
+
+#### Architecture ####
+#one conv per group and global average pooling in place of the teacher's dense head
+model = Sequential()
+model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu", input_shape=(128, 128, 1)))
+model.add(BatchNormalization())
+model.add(MaxPooling2D(pool_size=(2,2)))
+
+for _ in range(numGroups):
+    layer_size *= 2
+    model.add(Conv2D(layer_size, (3,3), padding="same", activation="relu"))
+    model.add(BatchNormalization())
+    model.add(MaxPooling2D(pool_size=(2,2)))
+
+model.add(GlobalAveragePooling2D())
+model.add(Dense(1))
+model.add(Activation('sigmoid'))
+model.compile(loss='binary_crossentropy',
+              optimizer=Adam(lr=0.001),
+              metrics=['accuracy'])
+model.summary()
+
+#trained on the blended targets, validated on the true labels
+model.fit_generator(ArraySequence(X_train, targets, batchSize, scale),
+                    validation_data=ArraySequence(X_test, y_test, batchSize, scale, shuffle=False),
+                    epochs=epochs, callbacks=callbacks)
+
+#%%
+##Speed/accuracy tradeoff of the best student checkpoint against the teacher
+studentPath = 'weights/{}.h5'.format(NAME)
+student_test = cachedPredictions(studentPath, X_test, prefix + "dataxtest.npy", scale)
+X_timed = dequantize(X_test[:volumeBatch * numTimedVolumes], scale)
+
+report = list()
+for path, prob in [(teacherPath, teacher_test), (studentPath, student_test)]:
+    row = {'model': os.path.basename(path),
+           'parameters': getModel(path).count_params(),
+           'size MB': os.path.getsize(path) / 2**20,
+           'ms per volume': timeVolumePredictions(getModel(path), X_timed, volumeBatch, numTimedVolumes)}
+    row.update(classificationScores(y_test, prob, threshold))
+    row['agreement with teacher'] = np.mean((prob > threshold) == (teacher_test > threshold))
+    report.append(row)
+
+reportDf = pd.DataFrame(report).set_index('model')
+reportDf['speedup'] = reportDf['ms per volume'].iloc[0] / reportDf['ms per volume']
+print(reportDf.to_string(float_format='%0.4f'))
+reportDf.to_csv(reportPath)
+print("Saved report to", reportPath)
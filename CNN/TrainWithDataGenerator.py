@@ -2,12 +2,11 @@ import os
 os.environ['KERAS_BACKEND']='plaidml.keras.backend'
 
 import numpy as np
-import random
 import time
 from keras.models import Sequential
 from keras.utils import Sequence
 from keras.layers import Dense, Dropout, Activation, Flatten, Conv2D, MaxPooling2D, ZeroPadding2D, BatchNormalization
-from DataGenerator import DataGenerator
+from InputPipeline import InputPipeline
 from LabelGenerator import LabelGenerator
 from keras.optimizers import Adam
 from keras.callbacks import ModelCheckpoint
@@ -15,28 +14,31 @@ from tensorflow.keras.callbacks import TensorBoard
 
 labelGenerator = LabelGenerator()
 labelGenerator.generateLabels()
-idList = labelGenerator.get_idList()
-labels = labelGenerator.get_labels()
-maxVals = labelGenerator.get_maxVals()
+sliceIndex = labelGenerator.get_sliceIndex()
+maxVals = sliceIndex.getMaxVals()
 
-random.seed(1)
-random.shuffle(idList)
+order = np.random.RandomState(1).permutation(len(sliceIndex))
 
-train_listIDs= idList[:int(len(idList)*0.05)]
-val_listIDs = idList[int(len(idList)*0.05):]
+train_listIDs= sliceIndex.subset(order[:int(len(order)*0.05)])
+val_listIDs = sliceIndex.subset(order[int(len(order)*0.05):])
 
-# Parameters
-params = {'labels': labels,
-          'max_brightness': maxVals,
+# Parameters, labels come from the slice index
+params = {'max_brightness': maxVals,
           'dim': (128,128),
           'batch_size': 64,
           'n_classes': 2,
           'n_channels': 1,
-          'shuffle': True}
+          'shuffle': True,
+          # crop slices to each scan's brain bounding box before resizing
+          'crop': False}
+
+# Pipeline parameters: batches are built ahead on a thread pool, training slices are cached once decoded
+pipelineParams = {'num_parallel_calls': 8,
+                  'prefetch': 16}
 
 # Generators
-training_generator = DataGenerator(train_listIDs, **params)
-validation_generator = DataGenerator(val_listIDs, **params)
+training_generator = InputPipeline(train_listIDs, cache_size=50000, report_every=500, **params, **pipelineParams)
+validation_generator = InputPipeline(val_listIDs, **params, **pipelineParams)
 
 # Design model
 layer_size = 16
@@ -79,5 +81,6 @@ model.compile(loss='categorical_crossentropy',
 # Train model on dataset
 model.fit_generator(generator=training_generator,
                     validation_data=validation_generator,
-                    use_multiprocessing=True,
-                    workers=2)
\ No newline at end of file
+                    use_multiprocessing=False,
+                    workers=1,
+                    shuffle=False)  # the pipeline prefetches batches in order and shuffles its samples itself
\ No newline at end of file
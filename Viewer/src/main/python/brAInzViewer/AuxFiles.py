@@ -0,0 +1,95 @@
+import os
+import numpy as np
+
+# b matrix column order: bxx, 2bxy, 2bxz, byy, 2byz, bzz
+BMATRIX_PAIRS = ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2))
+BMATRIX_COEFFICIENTS = np.array([1, 2, 2, 1, 2, 1], dtype=float)
+
+
+def scanStem(niiPath):
+    """Path of a scan without its .nii or .nii.gz extension, the .bval and .bvec files share it"""
+    if niiPath.endswith('.gz'):
+        niiPath = niiPath[:-3]
+    return os.path.splitext(niiPath)[0]
+
+
+def loadBval(path):
+    """Returns the b-values as a 1d array, or None if the file cannot be read"""
+    try:
+        return np.loadtxt(path, dtype=float, ndmin=1)
+    except Exception:
+        return None
+
+
+def loadBvec(path, numVolumes=None):
+    """Returns (bvec, columnOriented), bvec is always N x 3.
+    FSL writes one row per axis (3 x N), some scanners write one row per volume (N x 3); the layout is detected from
+    the number of volumes when known, otherwise from which side has length 3. Returns (None, False) if the file cannot
+    be read"""
+    try:
+        bvec = np.loadtxt(path, dtype=float, ndmin=2)
+    except Exception:
+        return None, False
+
+    if numVolumes is not None:
+        columnOriented = bvec.shape[0] != numVolumes and bvec.shape[1] == numVolumes
+    else:
+        columnOriented = bvec.shape[0] == 3 and bvec.shape[1] != 3
+
+    if columnOriented:
+        return bvec.T, True
+    return bvec, False
+
+
+def computeBMatrix(bvec, bval):
+    """Computes the N x 6 b matrix of bvec (N x 3) and bval (N), writing every column in place"""
+    bmatrix = np.empty((bvec.shape[0], 6))
+    for column, (i, j) in enumerate(BMATRIX_PAIRS):
+        np.multiply(bvec[:, i], bvec[:, j], out=bmatrix[:, column])
+    bmatrix *= BMATRIX_COEFFICIENTS
+    bmatrix *= bval[:, np.newaxis]
+    return bmatrix
+
+
+def formatRows(array, fmt, delimiter):
+    """Formats a 2d array into text with a single string operation instead of one call per element"""
+    numRows, numCols = array.shape
+    rowFormat = delimiter.join([fmt] * numCols) + '\n'
+    return (rowFormat * numRows) % tuple(array.ravel())
+
+
+def writeBMatrix(path, bmatrix):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(formatRows(bmatrix, '%12.8f', '\t'))
+
+
+def writeBvec(path, bvec, columnOriented=False):
+    """Writes bvec (N x 3), transposed back to 3 x N if the source file was column oriented"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(formatRows(bvec.T if columnOriented else bvec, '%.6f', ' '))
+
+
+def writeBval(path, bval):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(' '.join(['%.0f'] * len(bval)) % tuple(bval))
+
+
+def exportAuxFiles(sourcePath, destinationPath, volumes):
+    """Writes the .bvec, .bval and b matrix (.txt) files of the given volumes of a scan.
+    sourcePath and destinationPath are file paths without extension, volumes is a list of volume indices to keep"""
+    bval = loadBval(sourcePath + '.bval')
+    bvec, columnOriented = loadBvec(sourcePath + '.bvec', None if bval is None else bval.shape[0])
+
+    if bvec is not None:
+        bvec = bvec[volumes, ...]
+    if bval is not None:
+        bval = bval[volumes, ...]
+
+    if bvec is not None and bval is not None:
+        writeBMatrix(destinationPath + '.txt', computeBMatrix(bvec, bval))
+
+    if bvec is not None:
+        writeBvec(destinationPath + '.bvec', bvec, columnOriented)
+
+    if bval is not None:
+        writeBval(destinationPath + '.bval', bval)
@@ -0,0 +1,156 @@
+import json
+import os
+import numpy as np
+from DetectionService import isServiceUrl
+
+# Detection parameters used when no calibration file is given
+DEFAULT_CALIBRATION = {
+    'detectConfidenceThreshold': 0.7,  # slices scoring above this are bad
+    'detectSliceNumProportionThreshold': 0.5,  # volumes with at least this proportion of bad slices are flagged
+    'autoRemoveThreshold': 90,  # flagged volumes scoring at least this are removed in batch mode
+}
+
+
+def loadCalibration(path):
+    """Returns the detection parameters in a calibration file, missing parameters take their default value"""
+    calibration = dict(DEFAULT_CALIBRATION)
+    with open(path) as f:
+        saved = json.load(f)
+    calibration.update({key: saved[key] for key in DEFAULT_CALIBRATION if key in saved})
+    return calibration
+
+
+def calibrationModel(path):
+    """The detection model a calibration file was made for, None when it does not name one or the model is missing"""
+    with open(path) as f:
+        modelPath = json.load(f).get('detectorModel')
+    if modelPath is None or not (isServiceUrl(modelPath) or os.path.exists(modelPath)):
+        return None
+    return modelPath
+
+
+def saveCalibration(path, calibration, metrics=None, modelPath=None):
+    """Writes the detection parameters, with the metrics they were chosen on for reference.
+    modelPath names the model the parameters were tuned for, which the viewer then runs"""
+    saved = {key: calibration[key] for key in DEFAULT_CALIBRATION}
+    if metrics is not None:
+        saved['metrics'] = metrics
+    if modelPath is not None:
+        saved['detectorModel'] = modelPath if isServiceUrl(modelPath) else os.path.abspath(modelPath)
+    with open(path, 'w') as f:
+        json.dump(saved, f, indent=1)
+
+
+def predictionCachePath(niiPath):
+    return os.path.splitext(niiPath)[0] + '_predictions.npz'
+
+
+def stackPredictions(predictions):
+    """Turns a list indexed by volume of MotionDetector outputs (None for volumes that failed) into a
+    (volumes x slices) array, NaN for slices without a prediction"""
+    numSlices = max((len(p) for p in predictions if p is not None), default=0)
+    array = np.full((len(predictions), numSlices), np.nan, np.float32)
+    for v, prediction in enumerate(predictions):
+        if prediction is not None:
+            array[v, :len(prediction)] = np.asarray(prediction).reshape(-1)
+    return array
+
+
+def modelKey(modelPath):
+    """Identifies a model file by name, size and modification time, so a model retrained under the same name does not
+    match predictions of the old one. A detection service is identified by its url"""
+    if isServiceUrl(modelPath):
+        return modelPath
+    status = os.stat(modelPath)
+    return '{}|{}|{}'.format(os.path.basename(modelPath), status.st_size, status.st_mtime)
+
+
+def savePredictions(niiPath, predictions, modelPath):
+    """Caches the slice predictions of every volume of a scan next to it, as returned by stackPredictions"""
+    np.savez(predictionCachePath(niiPath), predictions=predictions, model=modelKey(modelPath))
+
+
+def loadPredictions(niiPath, modelPath=None):
+    """Returns the cached (volumes x slices) predictions of a scan, NaN for slices without a prediction.
+    None when there is no cache, or when it was made by a model other than modelPath or before it last changed"""
+    cachePath = predictionCachePath(niiPath)
+    if not os.path.exists(cachePath):
+        return None
+    with np.load(cachePath) as cache:
+        if modelPath is not None and str(cache['model']) != modelKey(modelPath):
+            return None
+        return cache['predictions']
+
+
+def scoreVolumes(predictions, confidenceThreshold, proportionThreshold):
+    """Classifies volumes from their (volumes x slices) predictions.
+    Returns (flagged, scores): volumes with at least proportionThreshold of their slices above confidenceThreshold
+    are flagged, the score is the mean slice prediction as a percentage. Volumes without predictions are not flagged"""
+    predictions = np.asarray(predictions, np.float32)
+    counted = ~np.isnan(predictions)
+    totalSliceCount = counted.sum(axis=1)
+    badSliceCount = (predictions > confidenceThreshold).sum(axis=1)
+    with np.errstate(invalid='ignore'):
+        scores = np.where(totalSliceCount > 0, np.nansum(predictions, axis=1) / np.maximum(totalSliceCount, 1) * 100,
+                          np.nan)
+    flagged = (totalSliceCount > 0) & (badSliceCount >= proportionThreshold * totalSliceCount)
+    return flagged, scores
+
+
+def gridSearch(predictions, isBad, confidenceThresholds, proportionThresholds, autoRemoveThresholds):
+    """Scores every combination of the three detection parameters against reference labels in one pass.
+    predictions is (volumes x slices) over all scans, isBad the reference label of each volume.
+    Returns a list of dicts with the parameters, confusion counts, precision, recall and f1 of the volumes
+    that would be removed in batch mode"""
+    predictions = np.asarray(predictions, np.float32)
+    isBad = np.asarray(isBad, bool)
+    confidenceThresholds = np.asarray(confidenceThresholds, float)
+    proportionThresholds = np.asarray(proportionThresholds, float)
+    autoRemoveThresholds = np.asarray(autoRemoveThresholds, float)
+
+    counted = ~np.isnan(predictions)
+    totalSliceCount = counted.sum(axis=1)
+    scores = np.floor(np.nansum(predictions, axis=1) / np.maximum(totalSliceCount, 1) * 100)
+    # (confidence, volume) bad slice counts, then (confidence, proportion, volume) flags
+    badSliceCount = (predictions[None] > confidenceThresholds[:, None, None]).sum(axis=2)
+    flagged = ((badSliceCount[:, None, :] >= proportionThresholds[None, :, None] * totalSliceCount)
+               & (totalSliceCount > 0))
+    # (confidence, proportion, autoRemove, volume)
+    removed = flagged[:, :, None, :] & (scores >= autoRemoveThresholds[:, None])[None, None]
+
+    tp = (removed & isBad).sum(axis=3)
+    fp = (removed & ~isBad).sum(axis=3)
+    fn = isBad.sum() - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+        recall = tp / max(isBad.sum(), 1)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    results = list()
+    for i, j, k in np.ndindex(tp.shape):
+        results.append({'detectConfidenceThreshold': float(confidenceThresholds[i]),
+                        'detectSliceNumProportionThreshold': float(proportionThresholds[j]),
+                        'autoRemoveThreshold': float(autoRemoveThresholds[k]),
+                        'tp': int(tp[i, j, k]), 'fp': int(fp[i, j, k]), 'fn': int(fn[i, j, k]),
+                        'precision': float(precision[i, j, k]), 'recall': float(recall[i, j, k]),
+                        'f1': float(f1[i, j, k])})
+    return results
+
+
+def scanName(name):
+    """Scan name as used in reference bad volume lists"""
+    name = os.path.basename(name.strip())
+    return name.replace('.nii', '').replace('_750', '').replace('.gz', '').upper()
+
+
+def readReferenceList(csvPath):
+    """Reads a 'Scan ID,Bad Volumes' csv (volumes 1-indexed, separated by ;) into {scan name: set of 0-indexed volumes}"""
+    reference = dict()
+    with open(csvPath, encoding='utf-8-sig') as f:
+        for line in f.readlines()[1:]:
+            if ',' not in line:
+                continue
+            name, vols = line.split(',', 1)
+            reference.setdefault(scanName(name), set()).update(
+                int(vol) - 1 for vol in vols.strip().split(';') if vol.strip() != '')
+    return reference
@@ -1,6 +1,14 @@
 from Views import *
 from Models import LabelData, LabelTypes, BadVolumes
-from MachineLearning import MotionDetector
+from Database import LabelDatabase
+from MachineLearning import MotionDetector, DetectionReader
+from Preprocessing import scanBrainBox, planeBox
+from SignalDropout import DROPOUT_THRESHOLD, dropoutScores
+from Similarity import scanOutliers
+from Projections import scanProjections
+from AuxFiles import exportAuxFiles
+from Calibration import DEFAULT_CALIBRATION, loadCalibration, calibrationModel, stackPredictions, savePredictions, \
+    scoreVolumes
 from PyQt5.QtWidgets import QWidget, QMainWindow
 from keras.models import load_model
 import nibabel as nib
@@ -13,37 +21,71 @@ import csv
 import time
 
 
+def environmentFlag(name):
+    """True when the environment variable is set to 1, true or yes"""
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes')
+
+
 class Controller(QMainWindow):
 
     def __init__(self, ctx):
         super(Controller, self).__init__()
         self.ctx = ctx
         self.data = None
-        self.detectConfidenceThreshold = 0.7
-        self.detectSliceNumProportionThreshold = 0.5
+        # Detection parameters, optionally from a calibration file made by CNN/CalibrateDetection.py
+        self.calibrationPath = os.environ.get('BRAINZ_CALIBRATION')
+        calibration = loadCalibration(self.calibrationPath) if self.calibrationPath else DEFAULT_CALIBRATION
+        self.detectConfidenceThreshold = calibration['detectConfidenceThreshold']
+        self.detectSliceNumProportionThreshold = calibration['detectSliceNumProportionThreshold']
+        self.autoRemoveThreshold = calibration['autoRemoveThreshold']
+        # Score slices in stages and stop once a volume is clearly good, see MotionDetector.predictCascade
+        self.detectCascade = environmentFlag('BRAINZ_DETECT_CASCADE')
+        # Crop slices to the brain bounding box before resizing, only for models trained on cropped slices
+        self.detectCrop = environmentFlag('BRAINZ_DETECT_CROP')
+        # Only run the CNN on this many volumes, those with the highest signal dropout score, None runs all of them
+        dropoutLimit = os.environ.get('BRAINZ_DETECT_DROPOUT_LIMIT')
+        self.detectDropoutLimit = int(dropoutLimit) if dropoutLimit else None
         halfWidth = 50
         lowerRange = 128 - halfWidth
         upperRange = 128 + halfWidth
         self.detectSliceRange = (lowerRange, upperRange)
         self.detectResizeDimension = (128, 128)
-        self.detectorModelPath = self.ctx.get_resource('model_v4.h5')
+        # A keras .h5 or quantized .tflite model (CNN/QuantizeModel.py) can replace the bundled one, such as the
+        # distilled student (CNN/TrainStudent.py), named directly or by the calibration file tuned for it.
+        # The url of a detection service (CNN/RunDetectionService.py) shares one loaded model between viewers
+        self.detectorModelPath = os.environ.get('BRAINZ_DETECTOR_MODEL') or \
+            (calibrationModel(self.calibrationPath) if self.calibrationPath else None) or \
+            self.ctx.get_resource('model_v4.h5')
         self.motionDetector = MotionDetector()
         self.volumeWithLabelsList = list()  # A list of volumes with labels
+        self.dropoutScores = None  # Model-free signal dropout score of every volume of the current file
+        self.outliers = None  # (scores, ranking, bval) of the current file from Similarity.scanOutliers
+        self.projections = None  # Per-volume projections of the current file, computed when the grid is shown
+        self.projectionGridView = None
 
         self.labelTypes = LabelTypes()
         self.labelData = LabelData(self)
         self.badVolumes = BadVolumes(self)
 
+        # Optional central label database shared across scans, per-scan csv files are still exported
+        self.labelDatabasePath = os.environ.get('BRAINZ_LABEL_DB')
+        self.labelDatabase = None
+        if self.labelDatabasePath:
+            self.labelDatabase = LabelDatabase(self.labelDatabasePath)
+            self.labelData.setDatabase(self.labelDatabase)
+            self.badVolumes.setDatabase(self.labelDatabase)
+
         self.niiPaths = list()
         self.nii = None
         self.rootFolder = None
         self.openFolder()
         self.fileSelected = None
-        self.autoRemoveThreshold = 90
 
         self.exportRootFolder = None
 
         self.showSlicing = True
+        self.showBrainBox = False
+        self.brainBox = None  # brain bounding box of the current file, computed on first use
         self.axialSliceNum = self.data.shape[2] // 2  # Default axial slice
         self.sagittalSliceNum = self.data.shape[0] // 2  # Default sagittal slice
         self.coronalSliceNum = self.data.shape[1] // 2  # Default coronal slice
@@ -150,13 +192,19 @@ class Controller(QMainWindow):
         self.clearPlots()
         self.fileSelected = file
         self.nii = nib.load(self.fileSelected)
+        self.brainBox = None
+        self.outliers = None
+        self.projections = None
         self.data = self.nii.get_fdata()
+        self.dropoutScores = dropoutScores(self.data)
         self.volumeSelectView.fileLabel.setText(file)
         self.volumeSelectView.setMaxSlider(self.data.shape[3] - 1)
-        self.labelData.setFilePath(self.fileSelected)  # set labelData to read new file
+        self.labelData.setFilePath(self.fileSelected, self.data.shape)  # set labelData to read new file
         self.badVolumes.setFilePath(self.fileSelected)  # set badVolumes to read new file
         self.checkSelectionRanges()
         self.updateViews()
+        if self.projectionGridView is not None and self.projectionGridView.isVisible():
+            self.projectionGridView.setProjections(self.getProjections())
 
     # def writeLabelsToFile(self):
     #     """Writes label data to csv file, returns True if write is successful"""
@@ -175,6 +223,26 @@ class Controller(QMainWindow):
         self.currentUpperBrightness = newUpperBrightness
         self.checkSelectionRanges()
         self.updateViews()
+        if self.projectionGridView is not None:
+            self.projectionGridView.setCurrentVolume(value)
+
+    def selectVolume(self, volume):
+        """Moves the volume slider to a volume, eg: when its projection is clicked"""
+        self.volumeSelectView.slider.setValue(volume)
+
+    def getProjections(self):
+        """Per-volume projections of the current file, cached next to it"""
+        if self.projections is None:
+            self.projections = scanProjections(self.nii, self.data)
+        return self.projections
+
+    def showProjectionGrid(self):
+        if self.projectionGridView is None:
+            self.projectionGridView = ProjectionGridView(self)
+        self.projectionGridView.setCurrentVolume(self.volumeNum)
+        self.projectionGridView.setProjections(self.getProjections())
+        self.projectionGridView.show()
+        self.projectionGridView.raise_()
 
     def markVolumeForExclusion(self):
         """Called upon by view to mark a volume for exclusion, add/remove vol number"""
@@ -248,6 +316,9 @@ class Controller(QMainWindow):
         if self.showSlicing:
             self.axialView.canvas.plotLines(sagittal_v=self.sagittalSliceNum, coronal_h=self.coronalSliceNum)
 
+        if self.showBrainBox:
+            self.axialView.canvas.plotBox(*planeBox(self.getBrainBox(), 2))
+
         self.axialLabelView.repaint()
 
     def updateSagittalView(self):
@@ -260,6 +331,9 @@ class Controller(QMainWindow):
         if self.showSlicing:
             self.sagittalView.canvas.plotLines(axial_h=self.axialSliceNum, coronal_v=self.coronalSliceNum)
 
+        if self.showBrainBox:
+            self.sagittalView.canvas.plotBox(*planeBox(self.getBrainBox(), 0))
+
         self.sagittalView.repaint()
 
     def updateCoronalView(self):
@@ -272,8 +346,21 @@ class Controller(QMainWindow):
         if self.showSlicing:
             self.coronalView.canvas.plotLines(axial_h=self.axialSliceNum, sagittal_v=self.sagittalSliceNum)
 
+        if self.showBrainBox:
+            self.coronalView.canvas.plotBox(*planeBox(self.getBrainBox(), 1))
+
         self.coronalView.repaint()
 
+    def getBrainBox(self):
+        """Brain bounding box of the current file, cached next to it"""
+        if self.brainBox is None:
+            self.brainBox = scanBrainBox(self.nii, self.data)
+        return self.brainBox
+
+    def setShowBrainBox(self, show):
+        self.showBrainBox = show
+        self.updateViews()
+
     def getSliceNum(self, sliceType):
         """Returns the current slice number given slice type"""
         if sliceType == 'Axial':
@@ -309,6 +396,8 @@ class Controller(QMainWindow):
         """Gets called by view when views are closed"""
         self.labelData.saveToFile()
         self.badVolumes.saveToFile()
+        if self.labelDatabase is not None:
+            self.labelDatabase.close()
 
     def getNumberOfVolumes(self):
         return self.data.shape[3]
@@ -331,13 +420,9 @@ class Controller(QMainWindow):
         for v in range(self.getNumberOfVolumes()):
             ticks.append(defaultTick)
 
-        for key, labels in self.labelData.labelData.items():
-            volume, _, _ = key
-            labelFlag = defaultTick
-            for label, value in labels.items():
-                if value is True:
-                    labelFlag = markerTick
-            ticks[volume] = labelFlag
+        labelledVolumes = self.labelData.getLabelledVolumes()[:len(ticks)]
+        for volume in np.flatnonzero(labelledVolumes):
+            ticks[volume] = markerTick
         # print(f'ticks {ticks}')
         return ticks
 
@@ -367,6 +452,35 @@ class Controller(QMainWindow):
         # print(f'DEBUG: badVolumeList: {self.badVolumeList}')
         return self.volumeWithLabelsList
 
+    def getVolumeSliderDropoutTicksData(self):
+        """Returns a list of characters to be placed in the view for the signal dropout ticks"""
+        if self.dropoutScores is None:
+            return list()
+        return [int(score) if score > DROPOUT_THRESHOLD else ' ' for score in self.dropoutScores]
+
+    def showOutlierRanking(self):
+        """Ranks the volumes of the current file by how far they deviate from the other volumes of their b-value shell,
+        and jumps to the one picked from the list"""
+        if self.outliers is None:
+            self.outliers = scanOutliers(self.fileSelected, self.data)
+        scores, ranking, bval = self.outliers
+        items = list()
+        for v in ranking:
+            shell = '' if bval is None or len(bval) != len(scores) else ', b={:g}'.format(bval[v])
+            items.append('Volume {}: score {:.1f}{}'.format(v + 1, scores[v], shell))
+        item, okPressed = QInputDialog.getItem(self, 'Outlier volumes',
+                                               'Volumes ranked by deviation from their b-value shell:', items, 0, False)
+        if okPressed:
+            self.volumeSelectView.slider.setValue(int(ranking[items.index(item)]))
+
+    def getDetectionVolumes(self):
+        """Volumes to run the CNN on, in order. With detectDropoutLimit set, only the volumes most likely to have
+        signal dropout, highest score first"""
+        numVols = self.data.shape[3]
+        if self.detectDropoutLimit is None or self.dropoutScores is None:
+            return list(range(numVols))
+        return [int(v) for v in np.argsort(-self.dropoutScores, kind='stable')[:self.detectDropoutLimit]]
+
     def saveNillFile(self):
         """Exports a new nii file"""
         if self.exportRootFolder == None or self.exportRootFolder == '':
@@ -401,54 +515,7 @@ class Controller(QMainWindow):
 
         # print(f'DEBUG: saveAuxFiles called: sourcePath= {sourcePath}, destinationPath={destinationPath}')
 
-        try:
-            bvec = np.loadtxt(sourcePath + '.bvec', dtype=float, delimiter=' ')
-            bvec = bvec[goodVolumes, ...]
-        except:
-            bvec = None
-
-        try:
-            bval = np.loadtxt(sourcePath + '.bval', dtype=float, delimiter=' ')
-            bval = bval[goodVolumes, ...]
-        except:
-            bval = None
-
-        if bvec is not None and bval is not None:
-            bmatrix = self.computeBMatrix(bvec, bval)
-
-            with open(destinationPath + '.txt', 'w', encoding='utf-8') as f:
-                for row in bmatrix:
-                    for index, elem in enumerate(row):
-                        f.write('{:12.8f}'.format(elem))
-                        if index < len(row)-1:
-                            f.write('\t')
-                    f.write('\n')
-
-        if bvec is not None:
-            np.savetxt(destinationPath + '.bvec', bvec, fmt='%.6f', delimiter=' ', newline='\n', encoding='utf-8')
-
-        if bval is not None:
-            with open(destinationPath + '.bval', 'w', encoding='utf-8') as f:
-                for index, elem in enumerate(bval):
-                    f.write('{:.0f}'.format(elem))
-                    if index < len(bval)-1:
-                        f.write(' ')
-
-    def computeBMatrix(self, bvec, bval):
-        X = np.zeros([bval.shape[0], 6])
-        for i in range(0, 6):
-            X[:, i] = bval
-        Y = np.zeros([bvec.shape[0], 6])
-        Y[:, 0] = np.multiply(bvec[:, 0], bvec[:, 0])
-        Y[:, 1] = np.multiply(2*bvec[:, 0], bvec[:, 1])
-        Y[:, 2] = np.multiply(2*bvec[:, 0], bvec[:, 2])
-        Y[:, 3] = np.multiply(bvec[:, 1], bvec[:, 1])
-        Y[:, 4] = np.multiply(2*bvec[:, 1], bvec[:, 2])
-        Y[:, 5] = np.multiply(bvec[:, 2], bvec[:, 2])
-
-        bmatrix = np.multiply(X, Y)
-
-        return bmatrix
+        exportAuxFiles(sourcePath, destinationPath, goodVolumes)
 
     def setExportDirectory(self):
 
@@ -489,7 +556,7 @@ class Controller(QMainWindow):
                 return
 
             self.autoRemoveThreshold, okPressed = QInputDialog.getDouble(
-                self, "Scanning all files", "Confidence threshold (volumes that score higher than this threshold in the motion detector will be automatically removed):", 90, 0, 99, 0)
+                self, "Scanning all files", "Confidence threshold (volumes that score higher than this threshold in the motion detector will be automatically removed):", self.autoRemoveThreshold, 0, 99, 0)
 
             if not okPressed:  # canceled
                 return
@@ -522,8 +589,22 @@ class Controller(QMainWindow):
 
         print("\nScanning...")
         self.progress.setLabelText(self.fileSelected)
-        self.predictions = []
-        self.thread = RunModel(self.data, self.motionDetector)
+        numVols = self.data.shape[3]
+        volumes = self.getDetectionVolumes()
+        self.predictions = [None] * numVols  # volumes the CNN is not run on stay None and are not flagged
+        self.detectedCount = 0
+        self.detectVolumeCount = len(volumes)
+        self.progress.setRange(0, len(volumes))
+        # The viewer always has the scan decoded (the views and the batch export need it), so slices are taken from
+        # memory. Streaming volumes from the file only applies to the headless tools (CNN/CalibrateDetection.py)
+        reader = DetectionReader(self.nii, self.detectSliceRange, data=self.data)
+        cascade = None
+        if self.detectCascade:
+            cascade = {'confidenceThreshold': self.detectConfidenceThreshold,
+                       'proportionThreshold': self.detectSliceNumProportionThreshold}
+        self.motionDetector.setBrainBox(self.getBrainBox() if self.detectCrop else None)
+        self.detectStartTime = time.time()
+        self.thread = RunModel(reader, self.motionDetector, cascade, volumes)
 
         # batch flag is passed either in args or kwargs (don't ask me) signal emit can't send keyword arguments
         if args:
@@ -539,36 +620,28 @@ class Controller(QMainWindow):
         self.volumeWithLabelsList.clear()
         self.mainWindow.setStatusMessage('Running detection model. Please wait...')
         numVols = self.data.shape[3]
-        badVolCount = 0
+        predictions = stackPredictions(self.predictions)
+        slicesPerVolume = np.sum(~np.isnan(predictions)) / max(numVols, 1)
+        print('Detection took {:.1f}s, {:.1f} slices evaluated per volume'.format(
+            time.time() - self.detectStartTime, slicesPerVolume))
+        # Cascade and dropout-limited runs leave slices or volumes unscored, their scores are not full detection scores
+        exhaustive = not self.detectCascade and self.detectDropoutLimit is None
+        if exhaustive:
+            # Cached per slice so CNN/CalibrateDetection.py can tune the parameters without rerunning the model
+            savePredictions(self.fileSelected, predictions, self.detectorModelPath)
+        flagged, volumeScores = scoreVolumes(predictions, self.detectConfidenceThreshold,
+                                             self.detectSliceNumProportionThreshold)
+        badVolCount = int(np.sum(flagged))
 
         for v in range(numVols):
-            volume = self.data[:, :, :, v]
-            totalSliceCount = 0
-            badSliceCount = 0
-            sliceConfidenceAccum = 0
-
-            prediction = self.predictions[v]
-            # Loop through each slice within the volume
-            if prediction is not None:
-                for slicePrediction in prediction:
-                    score = slicePrediction[0]
-
-                    if score > self.detectConfidenceThreshold:
-                        badSliceCount += 1
-
-                    sliceConfidenceAccum += score
-                    totalSliceCount += 1
-
-            # Summarizing predictin scores for the volume
-
-            if badSliceCount >= self.detectSliceNumProportionThreshold * totalSliceCount:
-
-                volumeScore = int(sliceConfidenceAccum / totalSliceCount * 100)
-                self.volumeWithLabelsList.append(volumeScore)
-                badVolCount += 1
+            if flagged[v]:
+                self.volumeWithLabelsList.append(int(volumeScores[v]))
             else:
                 self.volumeWithLabelsList.append(' ')  # Good volume ticker
 
+        if self.labelDatabase is not None and exhaustive and not np.any(np.isnan(volumeScores)):
+            self.labelDatabase.setScores(self.fileSelected, volumeScores.tolist())
+
         if 'batch' in kwargs and 'fileIndex' in kwargs:
             self.autoRemoveCorruptVolumes()
 
@@ -597,7 +670,7 @@ class Controller(QMainWindow):
         self.triPlaneView.enableButtons()
 
     def autoRemoveCorruptVolumes(self):
-        self.badVolumes.clear()
+        self.badVolumes.removeAll()
         print("----Results----")
         print("File " + self.fileSelected)
         for volIndex, volScore in enumerate(self.volumeWithLabelsList):
@@ -609,22 +682,24 @@ class Controller(QMainWindow):
                     # print(f"Appended vol {volIndex}")
                     self.badVolumes.append(volIndex)
 
-    def updateDetectionResults(self, prediction):
-        self.predictions.append(prediction)
-        self.progress.setValue(len(self.predictions))
+    def storeDetectionResult(self, result):
+        """Stores a (volume, prediction) result of RunModel, returns True once every volume is done"""
+        volume, prediction = result
+        self.predictions[volume] = prediction
+        self.detectedCount += 1
+        self.progress.setValue(self.detectedCount)
         self.mainWindow.setStatusMessage('Processing volume {}'.format(
-            len(self.predictions)) + ' of {}'.format(self.fileSelected))
-        if len(self.predictions) == self.data.shape[3]:
+            self.detectedCount) + ' of {}'.format(self.fileSelected))
+        return self.detectedCount == self.detectVolumeCount
+
+    def updateDetectionResults(self, result):
+        if self.storeDetectionResult(result):
             self.processPredictions()
 
-    def updateDetectionResultsThenRunNext(self, prediction):
+    def updateDetectionResultsThenRunNext(self, result):
         index = self.niiPaths.index(self.fileSelected)
 
-        self.predictions.append(prediction)
-        self.progress.setValue(len(self.predictions))
-        self.mainWindow.setStatusMessage('Processing volume {}'.format(
-            len(self.predictions)) + ' of {}'.format(self.fileSelected))
-        if len(self.predictions) == self.data.shape[3]:
+        if self.storeDetectionResult(result):
             self.processPredictions(batch=True, fileIndex=index)
 
 
@@ -651,19 +726,23 @@ class LoadModel(QThread):
 class RunModel(QThread):
     results = pyqtSignal(object)
 
-    def __init__(self, data, motionDetector):
+    def __init__(self, reader, motionDetector, cascade=None, volumes=None):
         QThread.__init__(self)
-        self.data = data
+        self.reader = reader
         self.motionDetector = motionDetector
+        self.cascade = cascade  # predictCascade thresholds, None scores every slice
+        self.volumes = volumes  # volumes to run on in order, None for all of them
 
     def runModel(self):
-        numVols = self.data.shape[3]
-        for v in range(numVols):
+        volumes = self.volumes if self.volumes is not None else range(self.reader.numVolumes())
+        for v in volumes:
             # print("Detecting slices in volume", v)
-            volume = self.data[:, :, :, v]
-            self.motionDetector.setMaxBrightness(np.amax(volume))  # Set normalization parameter
-            prediction = self.motionDetector.predictVolume(volume)
-            self.results.emit(prediction)
+            sagittal, coronal, maxBright = self.reader.read(v)  # normalization parameter cached per scan
+            if self.cascade is None:
+                prediction = self.motionDetector.predictPlanes(sagittal, coronal, maxBright)
+            else:
+                prediction = self.motionDetector.predictCascade(sagittal, coronal, maxBright, **self.cascade)
+            self.results.emit((v, prediction))
 
     def run(self):
         self.runModel()
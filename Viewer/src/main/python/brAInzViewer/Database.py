@@ -0,0 +1,190 @@
+import os
+import sqlite3
+from Models import PLANES
+
+
+class LabelDatabase:
+    """Optional central store for labels, bad volume marks and detection scores of all scans.
+    Replaces the per-scan csv files as the source of truth when configured; the csv files are still exported so that
+    other tools keep working. Runs in WAL mode so training scripts can query it while viewers are writing."""
+
+    def __init__(self, dbPath):
+        self.dbPath = dbPath
+        self.connection = sqlite3.connect(dbPath)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.createTables()
+        self.scanIds = dict()  # Key: nii path, Value: scan_id
+
+    def createTables(self):
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS scans (
+                    scan_id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    labels_synced INTEGER NOT NULL DEFAULT 0,
+                    exclusions_synced INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS labels (
+                    scan_id INTEGER NOT NULL REFERENCES scans(scan_id),
+                    volume INTEGER NOT NULL,
+                    plane INTEGER NOT NULL,
+                    slice INTEGER NOT NULL,
+                    label TEXT NOT NULL,
+                    value INTEGER NOT NULL,
+                    PRIMARY KEY (scan_id, volume, plane, slice, label)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS comments (
+                    scan_id INTEGER NOT NULL REFERENCES scans(scan_id),
+                    volume INTEGER NOT NULL,
+                    plane INTEGER NOT NULL,
+                    slice INTEGER NOT NULL,
+                    comment TEXT NOT NULL,
+                    PRIMARY KEY (scan_id, volume, plane, slice)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS exclusions (
+                    scan_id INTEGER NOT NULL REFERENCES scans(scan_id),
+                    volume INTEGER NOT NULL,
+                    PRIMARY KEY (scan_id, volume)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS scores (
+                    scan_id INTEGER NOT NULL REFERENCES scans(scan_id),
+                    volume INTEGER NOT NULL,
+                    score REAL NOT NULL,
+                    PRIMARY KEY (scan_id, volume)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS labels_by_label ON labels (label, value);
+                CREATE INDEX IF NOT EXISTS scores_by_score ON scores (score);
+            ''')
+
+    def close(self):
+        self.connection.close()
+
+    def getScanId(self, filePath):
+        """Returns the scan_id of a nii file, registering the file if it is not in the database yet"""
+        path = os.path.realpath(filePath)
+        if path not in self.scanIds:
+            with self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO scans (path, name) VALUES (?, ?)',
+                                        (path, os.path.basename(path)))
+            row = self.connection.execute('SELECT scan_id FROM scans WHERE path = ?', (path,)).fetchone()
+            self.scanIds[path] = row[0]
+        return self.scanIds[path]
+
+    def isSynced(self, filePath, column):
+        """Returns True if the labels_synced/exclusions_synced flag is set, ie: the csv files were imported before"""
+        row = self.connection.execute('SELECT {} FROM scans WHERE scan_id = ?'.format(column),
+                                      (self.getScanId(filePath),)).fetchone()
+        return row[0] == 1
+
+    # Labels
+
+    def importLabels(self, filePath, labelData):
+        """Stores the label data read from a scan's csv file, done once per scan.
+        labelData is an iterable of ((volume, sliceType, sliceNum), {label: value}), as given by LabelData.items()"""
+        scanId = self.getScanId(filePath)
+        labelRows = list()
+        commentRows = list()
+        for (volume, sliceType, sliceNum), labels in labelData:
+            plane = PLANES.index(sliceType)
+            for label, value in labels.items():
+                if label == 'comment':
+                    commentRows.append((scanId, volume, plane, sliceNum, value))
+                else:
+                    labelRows.append((scanId, volume, plane, sliceNum, label, 1 if value is True else 0))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?)', labelRows)
+            self.connection.executemany('INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?)', commentRows)
+            self.connection.execute('UPDATE scans SET labels_synced = 1 WHERE scan_id = ?', (scanId,))
+
+    def getLabels(self, filePath):
+        """Returns label data in the LabelData format, key: (volume, sliceType, sliceNum), value: {label: value}"""
+        scanId = self.getScanId(filePath)
+        labelData = dict()
+        for volume, plane, sliceNum, label, value in self.connection.execute(
+                'SELECT volume, plane, slice, label, value FROM labels WHERE scan_id = ?', (scanId,)):
+            labelData.setdefault((volume, PLANES[plane], sliceNum), dict())[label] = value == 1
+        for volume, plane, sliceNum, comment in self.connection.execute(
+                'SELECT volume, plane, slice, comment FROM comments WHERE scan_id = ?', (scanId,)):
+            labelData.setdefault((volume, PLANES[plane], sliceNum), dict())['comment'] = comment
+        return labelData
+
+    def setLabel(self, filePath, volume, sliceType, sliceNum, label, value):
+        """Stores a label value, or a comment when label is 'comment' (an empty comment removes it)"""
+        if label == 'comment':
+            self.setComment(filePath, volume, sliceType, sliceNum, value)
+            return
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?)',
+                                    (self.getScanId(filePath), volume, PLANES.index(sliceType), sliceNum, label,
+                                     1 if value is True else 0))
+
+    def setComment(self, filePath, volume, sliceType, sliceNum, comment):
+        key = (self.getScanId(filePath), volume, PLANES.index(sliceType), sliceNum)
+        with self.connection:
+            if comment:
+                self.connection.execute('INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?)', key + (comment,))
+            else:
+                self.connection.execute('DELETE FROM comments WHERE scan_id = ? AND volume = ? AND plane = ? '
+                                        'AND slice = ?', key)
+
+    # Bad volumes
+
+    def importExclusions(self, filePath, volumes):
+        """Stores the bad volumes read from a scan's csv file, done once per scan"""
+        scanId = self.getScanId(filePath)
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO exclusions VALUES (?, ?)',
+                                        [(scanId, volume) for volume in volumes])
+            self.connection.execute('UPDATE scans SET exclusions_synced = 1 WHERE scan_id = ?', (scanId,))
+
+    def getExclusions(self, filePath):
+        return [row[0] for row in self.connection.execute(
+            'SELECT volume FROM exclusions WHERE scan_id = ? ORDER BY volume', (self.getScanId(filePath),))]
+
+    def setExclusion(self, filePath, volume, excluded):
+        scanId = self.getScanId(filePath)
+        with self.connection:
+            if excluded:
+                self.connection.execute('INSERT OR IGNORE INTO exclusions VALUES (?, ?)', (scanId, volume))
+            else:
+                self.connection.execute('DELETE FROM exclusions WHERE scan_id = ? AND volume = ?', (scanId, volume))
+
+    def clearExclusions(self, filePath):
+        with self.connection:
+            self.connection.execute('DELETE FROM exclusions WHERE scan_id = ?', (self.getScanId(filePath),))
+
+    # Detection scores
+
+    def setScores(self, filePath, scores):
+        """Stores the detection score of every volume, scores is a list indexed by volume"""
+        scanId = self.getScanId(filePath)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)',
+                                        [(scanId, volume, score) for volume, score in enumerate(scores)])
+
+    def getScores(self, filePath):
+        return [row[0] for row in self.connection.execute(
+            'SELECT score FROM scores WHERE scan_id = ? ORDER BY volume', (self.getScanId(filePath),))]
+
+    # Cohort-wide queries
+
+    def getExcludedVolumes(self, minScore=None):
+        """Returns (path, volume, score) of every excluded volume across all scans,
+        optionally only those whose detection score is above minScore"""
+        if minScore is None:
+            return self.connection.execute(
+                'SELECT s.path, e.volume, sc.score FROM exclusions e JOIN scans s USING (scan_id) '
+                'LEFT JOIN scores sc USING (scan_id, volume) ORDER BY s.path, e.volume').fetchall()
+        return self.connection.execute(
+            'SELECT s.path, e.volume, sc.score FROM exclusions e JOIN scans s USING (scan_id) '
+            'JOIN scores sc USING (scan_id, volume) WHERE sc.score > ? ORDER BY s.path, e.volume',
+            (minScore,)).fetchall()
+
+    def getLabelledSlices(self, label):
+        """Returns (path, volume, plane, slice) of every slice across all scans that has the label set"""
+        return [(path, volume, PLANES[plane], sliceNum) for path, volume, plane, sliceNum in self.connection.execute(
+            'SELECT s.path, l.volume, l.plane, l.slice FROM labels l JOIN scans s USING (scan_id) '
+            'WHERE l.label = ? AND l.value = 1', (label,))]
@@ -0,0 +1,210 @@
+import collections
+import io
+import json
+import queue
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+import numpy as np
+
+DEFAULT_PORT = 8765
+# Requests arriving within this many milliseconds of the oldest waiting one are predicted in the same batch
+MAX_LATENCY_MS = 10
+# Batches stop collecting requests once they hold this many slices
+MAX_BATCH = 512
+# Throughput is averaged over the batches of the last this many seconds
+THROUGHPUT_WINDOW = 60
+# Seconds a request waits for its prediction before giving up
+REQUEST_TIMEOUT = 120
+
+
+def encodeArray(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decodeArray(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def isServiceUrl(modelPath):
+    return modelPath.startswith('http://')
+
+
+class BatchingPredictor:
+    """Merges the slices of concurrent requests into larger batches for one predict function, which only ever runs
+    on the predictor's own thread. A batch is predicted once it holds maxBatch slices or its oldest request has
+    waited maxLatency milliseconds"""
+
+    def __init__(self, predict, maxLatency=MAX_LATENCY_MS, maxBatch=MAX_BATCH):
+        self.predict = predict
+        self.maxLatency = maxLatency / 1000
+        self.maxBatch = maxBatch
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = {'requests': 0, 'slices': 0, 'batches': 0, 'failed': 0}
+        self.waitTime = 0.0
+        self.predictTime = 0.0
+        self.recent = collections.deque()  # (time, slices) of recent batches, for throughput
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, slices, timeout=REQUEST_TIMEOUT):
+        """Blocks until the slices are predicted, returns None when the model failed or timeout seconds passed"""
+        request = {'slices': slices, 'arrived': time.time(), 'done': threading.Event(), 'prediction': None}
+        self.requests.put(request)
+        if not request['done'].wait(timeout):
+            return None
+        return request['prediction']
+
+    def nextBatch(self, batch):
+        """Collects the requests of the next batch into the batch list"""
+        batch.append(self.requests.get())
+        size = len(batch[0]['slices'])
+        deadline = batch[0]['arrived'] + self.maxLatency
+        while size < self.maxBatch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request['slices'])
+
+    def predictBatch(self, batch):
+        """Predictions of every request of a batch in one call, or one call per request when their slices differ
+        in shape"""
+        try:
+            slices = np.concatenate([request['slices'] for request in batch])
+        except ValueError:
+            return [self.predict(request['slices']) for request in batch]
+        prediction = self.predict(slices)
+        if prediction is None:
+            return [None] * len(batch)
+        bounds = np.cumsum([0] + [len(request['slices']) for request in batch])
+        return [prediction[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def run(self):
+        while True:
+            batch = list()
+            try:
+                self.runBatch(batch)
+            except Exception as e:
+                # a bad batch fails its own requests only, the thread keeps serving the next ones
+                print('DEBUG: detection service failed to predict a batch.')
+                print(e)
+                with self.lock:
+                    self.counts['failed'] += sum(not request['done'].is_set() for request in batch)
+                for request in batch:
+                    request['done'].set()
+
+    def runBatch(self, batch):
+        self.nextBatch(batch)
+        start = time.time()
+        predictions = self.predictBatch(batch)
+        end = time.time()
+        for request, prediction in zip(batch, predictions):
+            request['prediction'] = prediction
+            request['done'].set()
+
+        numSlices = sum(len(request['slices']) for request in batch)
+        with self.lock:
+            self.counts['requests'] += len(batch)
+            self.counts['slices'] += numSlices
+            self.counts['batches'] += 1
+            self.counts['failed'] += sum(prediction is None for prediction in predictions)
+            self.waitTime += sum(start - request['arrived'] for request in batch)
+            self.predictTime += end - start
+            self.recent.append((end, numSlices))
+            while self.recent[0][0] < end - THROUGHPUT_WINDOW:
+                self.recent.popleft()
+
+    def metrics(self):
+        """Queue depth, totals, mean batch size, mean queue wait and model time, and recent slices per second"""
+        with self.lock:
+            now = time.time()
+            recentSlices = sum(n for t, n in self.recent if t >= now - THROUGHPUT_WINDOW)
+            metrics = dict(self.counts)
+            metrics.update({
+                'queueDepth': self.requests.qsize(),
+                'meanBatchSize': self.counts['slices'] / max(self.counts['batches'], 1),
+                'meanWaitMs': self.waitTime / max(self.counts['requests'], 1) * 1000,
+                'meanPredictMs': self.predictTime / max(self.counts['batches'], 1) * 1000,
+                'slicesPerSecond': recentSlices / max(min(THROUGHPUT_WINDOW, now - self.started), 1e-9),
+                'uptime': now - self.started,
+            })
+            return metrics
+
+
+class DetectionRequestHandler(BaseHTTPRequestHandler):
+    """POST /predict with a .npy array of slices returns a .npy array of predictions, GET /metrics returns json"""
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            slices = decodeArray(self.rfile.read(int(self.headers['Content-Length'])))
+        except (TypeError, ValueError):
+            self.send_error(400, 'Expected a .npy array of slices')
+            return
+        if slices.ndim != 4 or len(slices) == 0:
+            self.send_error(400, 'Expected a (slices, rows, cols, channels) array')
+            return
+        prediction = self.server.predictor.submit(slices)
+        if prediction is None:
+            self.send_error(500, 'Detection model failed')
+            return
+        self.reply(encodeArray(prediction), 'application/octet-stream')
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self.reply(json.dumps(self.server.predictor.metrics()).encode('utf-8'), 'application/json')
+
+    def reply(self, body, contentType):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per prediction request otherwise
+
+
+class DetectionServer(ThreadingMixIn, HTTPServer):
+    """Serves one warm detection model on localhost to every viewer and batch tool on the machine.
+    predict is the model's prediction function, eg: MotionDetector.predictSlices"""
+    daemon_threads = True
+
+    def __init__(self, predict, port=DEFAULT_PORT, maxLatency=MAX_LATENCY_MS, maxBatch=MAX_BATCH, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), DetectionRequestHandler)
+        self.predictor = BatchingPredictor(predict, maxLatency, maxBatch)
+
+
+class RemoteModel:
+    """A model served by a DetectionServer, with the predict interface of a keras model"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def predict(self, x, batch_size=None):
+        request = Request(self.url + '/predict', data=encodeArray(np.asarray(x, np.float32)),
+                          headers={'Content-Type': 'application/octet-stream'})
+        with urlopen(request) as response:
+            return decodeArray(response.read())
+
+    def predict_on_batch(self, x):
+        return self.predict(x)
+
+    def metrics(self):
+        with urlopen(self.url + '/metrics') as response:
+            return json.loads(response.read().decode('utf-8'))
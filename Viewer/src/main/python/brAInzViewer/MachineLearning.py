@@ -1,9 +1,59 @@
+import os
 import numpy as np
 import cv2
+from Preprocessing import scanCacheKey, cropPlanes
+from DetectionService import RemoteModel, isServiceUrl
 import tensorflow as tf
 graph = tf.get_default_graph()
 from keras.models import load_model
 
+def loadDetectionModel(modelPath):
+    """Loads a keras .h5 model, a TensorFlow Lite model converted by CNN/QuantizeModel.py, or connects to the model
+    of a detection service given its url (eg: http://127.0.0.1:8765, see CNN/RunDetectionService.py)"""
+    if isServiceUrl(modelPath):
+        return RemoteModel(modelPath)
+    if os.path.splitext(modelPath)[1] == '.tflite':
+        return TFLiteModel(modelPath)
+    return load_model(modelPath)
+
+
+class TFLiteModel:
+    """Runs a .tflite model with the predict interface of a keras model.
+    Inputs and outputs of fully integer models are quantized and dequantized with the model's own parameters"""
+
+    def __init__(self, modelPath):
+        self.interpreter = tf.lite.Interpreter(model_path=modelPath)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batchSize = self.input['shape'][0]
+
+    def predict(self, x, batch_size=None):
+        x = np.asarray(x, np.float32)
+        if len(x) != self.batchSize:
+            self.interpreter.resize_tensor_input(self.input['index'], x.shape)
+            self.interpreter.allocate_tensors()
+            self.batchSize = len(x)
+        scale, zeroPoint = self.input['quantization']
+        if self.input['dtype'] != np.float32:
+            x = np.clip(np.round(x / scale + zeroPoint), *integerRange(self.input['dtype']))
+        self.interpreter.set_tensor(self.input['index'], x.astype(self.input['dtype']))
+        self.interpreter.invoke()
+        prediction = self.interpreter.get_tensor(self.output['index'])
+        scale, zeroPoint = self.output['quantization']
+        if self.output['dtype'] != np.float32:
+            prediction = (prediction.astype(np.float32) - zeroPoint) * scale
+        return prediction.astype(np.float32)
+
+    def predict_on_batch(self, x):
+        return self.predict(x)
+
+
+def integerRange(dtype):
+    info = np.iinfo(dtype)
+    return info.min, info.max
+
+
 class MotionDetector:
 
     def __init__(self):
@@ -11,50 +61,160 @@ class MotionDetector:
         self.detectSliceRange = None
         self.maxBright = None  # used for normalizing voxel brightness values
         self.dim = None
+        self.brainBox = None  # slices are cropped to this box before resizing when set
 
     def setModel(self, modelPath, sliceRange, dimension):
         #self.model = model
         global graph
         with graph.as_default():
-            self.model = load_model(modelPath)
+            self.model = loadDetectionModel(modelPath)
         self.detectSliceRange = sliceRange
         self.dim = dimension
 
     def setDetectSliceRange(self, rangeVal):
         self.detectSliceRange = rangeVal
 
+    def setBrainBox(self, box):
+        """Crops slices to a Preprocessing.scanBrainBox box before resizing, None to use whole slices.
+        The model must have been trained on slices cropped the same way"""
+        self.brainBox = box
+
     def setMaxBrightness(self, value):
         self.maxBright = value
 
     def normalize(self, volume):
         return volume / np.amax(volume)
 
+    def samplePlanes(self, volume):
+        """Returns the sagittal and coronal slices the detector uses, every 10th within detectSliceRange"""
+        return sampledPlanes(volume, self.detectSliceRange)
+
     def resize(self, volume):
-        #numSlices = self.detectSliceRange[1] - self.detectSliceRange[0]
-        resized = np.zeros((20, self.dim[0], self.dim[1], 1))
-        i = 0
-        for s in range(self.detectSliceRange[0], self.detectSliceRange[1], 10):  # for each sagittal slice
-            img = volume[s, :, :]
-            img = cv2.resize(img, (self.dim[0], self.dim[1]), interpolation=cv2.INTER_NEAREST)
-            resized[i, :, :, 0] = img
-            i += 1
-        for s in range(self.detectSliceRange[0], self.detectSliceRange[1], 10):  # for each coronal slice
-            img = volume[:, s, :]
-            img = cv2.resize(img, (self.dim[0], self.dim[1]), interpolation=cv2.INTER_NEAREST)
-            resized[i, :, :, 0] = img
-            i += 1
+        return self.resizePlanes(*self.samplePlanes(volume))
+
+    def resizePlanes(self, sagittal, coronal):
+        """Resizes the sampled (slice, row, col) sagittal and coronal planes into a batch for the model"""
+        if self.brainBox is not None:
+            sagittal, coronal = cropPlanes(sagittal, coronal, self.brainBox)
+        resized = np.zeros((len(sagittal) + len(coronal), self.dim[0], self.dim[1], 1))
+        for i, img in enumerate(list(sagittal) + list(coronal)):
+            resized[i, :, :, 0] = cv2.resize(img, (self.dim[0], self.dim[1]), interpolation=cv2.INTER_NEAREST)
         return resized
 
     def predictVolume(self, volume):
-        slices = self.resize(self.normalize(volume))
+        return self.predictPlanes(*self.samplePlanes(volume), np.amax(volume))
+
+    def predictPlanes(self, sagittal, coronal, maxBright=None):
+        """Predicts from the sampled planes of a volume only, normalized by the volume's maximum brightness
+        (maxBright, or the value set with setMaxBrightness)"""
+        if maxBright is None:
+            maxBright = self.maxBright
+        return self.predictSlices(self.resizePlanes(sagittal / maxBright, coronal / maxBright))
+
+    def predictCascade(self, sagittal, coronal, maxBright, confidenceThreshold, proportionThreshold,
+                       stages=(4, 12), clearThreshold=0.1):
+        """Like predictPlanes, but scores the slices in stages and stops as soon as the volume can no longer be
+        flagged (too few slices left to reach proportionThreshold of them above confidenceThreshold) or every
+        slice scored so far is below clearThreshold. stages are the cumulative slice counts after which to check.
+        Volumes that are or may be flagged are scored in full so their score is exact.
+        Slices that were not scored are NaN in the returned prediction"""
+        slices = self.resizePlanes(sagittal / maxBright, coronal / maxBright)
+        numSlices = len(slices)
+        order = cascadeOrder(numSlices, stages[0])
+        prediction = np.full((numSlices, 1), np.nan, np.float32)
+        start = 0
+        for end in [b for b in stages if b < numSlices] + [numSlices]:
+            stagePrediction = self.predictSlices(slices[order[start:end]])
+            if stagePrediction is None:
+                return None
+            prediction[order[start:end]] = stagePrediction
+            start = end
+
+            scored = prediction[order[:end], 0]
+            badSliceCount = np.sum(scored > confidenceThreshold)
+            if badSliceCount + numSlices - end < proportionThreshold * numSlices:  # can no longer be flagged
+                break
+            if np.all(scored < clearThreshold):
+                break
+        return prediction
+
+    def predictSlices(self, slices):
         try:
             global graph
             with graph.as_default():
                 prediction = self.model.predict(slices)
-            
+
             # print(f'DEBUG: Predictions: {predictions}')
             return prediction
         except Exception as e:
             print('DEBUG: failed to run detection model.')
             print(e)
 
+
+def cascadeOrder(numSlices, firstStage):
+    """Slice order for predictCascade, the first stage is spread evenly across both planes"""
+    first = np.unique(np.linspace(0, numSlices - 1, firstStage).round().astype(int))
+    return np.concatenate([first, np.setdiff1d(np.arange(numSlices), first)])
+
+
+def sampledPlanes(volume, sliceRange, step=10):
+    """Every step-th sagittal and coronal slice within sliceRange of a 3D volume, as (slice, row, col) arrays"""
+    sagittal = volume[sliceRange[0]:sliceRange[1]:step, :, :]
+    coronal = np.moveaxis(volume[:, sliceRange[0]:sliceRange[1]:step, :], 1, 0)
+    return sagittal, coronal
+
+
+class DetectionReader:
+    """Reads the slices the detector uses from a scan one volume at a time.
+    Slices come from the in-memory data when the scan is already loaded, otherwise each volume is read on its own
+    straight from the nii file's data object, so detection starts without decoding the whole scan. The sampled
+    sagittal planes interleave with every row of a volume on disk, so a volume is read in one contiguous block
+    rather than plane by plane. Volume maxima used for normalization are cached next to the scan in _volumemax.npz"""
+
+    def __init__(self, nii, sliceRange, step=10, data=None):
+        self.nii = nii
+        self.sliceRange = sliceRange
+        self.step = step
+        self.data = data
+        self.maxima = None
+
+    def numVolumes(self):
+        return self.nii.shape[3]
+
+    def readVolume(self, v):
+        if self.data is not None:
+            return self.data[:, :, :, v]
+        return np.asarray(self.nii.dataobj[..., v], dtype=np.float64)
+
+    def read(self, v):
+        """Returns the (sagittal, coronal) sampled planes of volume v and its maximum brightness"""
+        if self.maxima is None:
+            self.maxima = self.loadMaxima()
+        volume = self.readVolume(v)
+        if np.isnan(self.maxima[v]):
+            self.maxima[v] = np.amax(volume)
+            if not np.any(np.isnan(self.maxima)):
+                self.saveMaxima()
+        sagittal, coronal = sampledPlanes(volume, self.sliceRange, self.step)
+        return sagittal, coronal, self.maxima[v]
+
+    def cachePath(self):
+        return os.path.splitext(self.nii.get_filename())[0] + '_volumemax.npz'
+
+    def loadMaxima(self):
+        """Cached maxima of the scan, NaN for every volume when the cache is missing or the scan changed since"""
+        key = scanCacheKey(self.nii)
+        if key is not None and os.path.exists(self.cachePath()):
+            with np.load(self.cachePath()) as cache:
+                if np.array_equal(cache['key'], key) and len(cache['maxima']) == self.numVolumes():
+                    return cache['maxima'].astype(np.float64)
+        return np.full(self.numVolumes(), np.nan)
+
+    def saveMaxima(self):
+        key = scanCacheKey(self.nii)
+        if key is None:
+            return
+        try:
+            np.savez(self.cachePath(), maxima=self.maxima, key=key)
+        except OSError:
+            print('DEBUG: failed to cache volume maxima')
@@ -1,5 +1,9 @@
 import os
 import csv
+import numpy as np
+
+PLANES = ('Axial', 'Sagittal', 'Coronal')  # plane codes are the indices, same as the CNN slice_type
+PLANE_AXES = {'Axial': 2, 'Sagittal': 0, 'Coronal': 1}  # axis of the nii data each plane slices along
 
 
 class LabelTypes:
@@ -44,6 +48,73 @@ class LabelTypes:
             self.labelData[category] = labels
 
 
+class Journal:
+    """Append-only log of edits made to a given nii file's labels or bad volumes.
+    Each edit is written as one csv row and flushed to disk right away, so a crash loses nothing. The owner replays
+    the log on top of its csv file when the nii file is re-opened, and compacts it back into the csv file once it
+    grows past compactThreshold rows"""
+
+    def __init__(self, suffix, compactThreshold=500):
+        self.suffix = suffix
+        self.compactThreshold = compactThreshold
+        self.filePath = None
+        self.file = None
+        self.writer = None
+        self.entryCount = 0
+
+    def setFilePath(self, file):
+        self.close()
+        self.filePath = os.path.splitext(file)[0] + self.suffix
+        self.entryCount = 0
+
+    def read(self):
+        """Returns the rows logged since the last compaction"""
+        rows = list()
+        try:
+            with open(self.filePath, newline='') as file:
+                for row in csv.reader(file, delimiter=','):
+                    rows.append(row)
+        except FileNotFoundError:
+            pass
+        self.entryCount = len(rows)
+        return rows
+
+    def append(self, row):
+        """Persists a single edit, returns True once the journal is due for compaction"""
+        if self.filePath is None:
+            return False
+        if self.file is None:
+            self.file = open(self.filePath, mode='a', newline='')
+            self.writer = csv.writer(self.file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self.writer.writerow(row)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entryCount += 1
+        return self.entryCount >= self.compactThreshold
+
+    def truncate(self):
+        """Discards the logged rows, called after their content has been written to the csv file"""
+        self.close()
+        if self.filePath is not None and os.path.exists(self.filePath):
+            os.remove(self.filePath)
+        self.entryCount = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
+
+
+def replaceFile(filePath, rows):
+    """Writes rows to a csv file through a temporary file, so an interrupted write never leaves a partial file"""
+    tmpPath = filePath + '.tmp'
+    with open(tmpPath, mode='w', newline='') as file:
+        writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerows(rows)
+    os.replace(tmpPath, filePath)
+
+
 class BadVolumes:
     """Keeps track of bad volumes for a given nii file"""
 
@@ -52,20 +123,69 @@ class BadVolumes:
         self.filePath = None
         self.changed = False
         self.data = list()
+        self.journal = Journal('_badvolumes.journal')
+        self.database = None  # optional LabelDatabase, replaces the journal when set
 
     def append(self, value):
         self.data.append(value)
         self.changed = True
+        self.log(value, True)
 
     def remove(self, value):
         self.data.remove(value)
         self.changed = True
+        self.log(value, False)
+
+    def removeAll(self):
+        """Un-marks every volume, unlike clear() this is an edit that gets persisted"""
+        self.clear()
+        self.changed = True
+        if self.database is not None:
+            self.database.clearExclusions(self.filePath)
+        else:
+            self.log('*', False)
+
+    def log(self, volume, excluded):
+        if self.database is not None:
+            self.database.setExclusion(self.filePath, volume, excluded)
+        elif self.journal.append([volume, 1 if excluded else 0]):
+            self.compact()
+
+    def setDatabase(self, database):
+        self.database = database
 
     def setFilePath(self, file):
         self.filePath = file
+        self.journal.setFilePath(file)
         self.clear()
         self.changed = False
-        self.readFromFile()
+
+        if self.database is not None and self.database.isSynced(file, 'exclusions_synced'):
+            self.data.extend(self.database.getExclusions(file))
+        else:
+            self.readFromFile()
+            self.replayJournal()
+            if self.database is not None:
+                self.database.importExclusions(file, self.data)
+
+    def replayJournal(self):
+        """Re-applies the edits logged since the last compaction on top of the csv content"""
+        for row in self.journal.read():
+            if len(row) != 2:
+                continue  # torn row from an interrupted write
+            volume, excluded = row
+            if volume == '*':
+                self.clear()
+            else:
+                try:
+                    volume = int(volume)
+                except ValueError:
+                    continue
+                if excluded == '1' and volume not in self.data:
+                    self.data.append(volume)
+                elif excluded == '0' and volume in self.data:
+                    self.data.remove(volume)
+            self.changed = True
 
     def readFromFile(self):
         try:
@@ -83,49 +203,86 @@ class BadVolumes:
     def clear(self):
         self.data.clear()
 
-    def saveToFile(self):
+    def compact(self):
+        """Exports the bad volumes to _badvolumes.csv and truncates the journal"""
         try:
             badVolumesFile = os.path.splitext(self.filePath)[0] + '_badvolumes.csv'
-            with open(badVolumesFile, mode='w', newline='') as file:
-                writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(['bad_volume_num(zero-index: starting with volume 0)'])
-
-                for vol in self.data:
-                    writer.writerow([vol])
-
-            self.clear()
-            # print("Saved _badvolumes.csv")
+            rows = [['bad_volume_num(zero-index: starting with volume 0)']]
+            rows.extend([vol] for vol in self.data)
+            replaceFile(badVolumesFile, rows)
+            self.journal.truncate()
+            self.changed = False
             return True
 
         except Exception as e:
             print('DEBUG: BadVolumes encountered error while writing to file.')
             return False
 
+    def saveToFile(self):
+        if self.compact():
+            self.clear()
+            # print("Saved _badvolumes.csv")
+            return True
+        return False
+
 
 class LabelData:
     """Keeps the current instance's label data for the .nii file that is open.
     This object is shared across all volumes for a given .nii file so that we don't save/read from disk each time
-    the volume slider is moved, and allowing smooth scrubbing of the volume slider"""
+    the volume slider is moved, and allowing smooth scrubbing of the volume slider.
+    Labels are kept as one bit array per plane of shape (volumes, slices), each label type owns one bit, so queries
+    over all volumes are vectorized. Comments are rare and are kept in a sparse dictionary"""
 
     def __init__(self, controller):
         self.controller = controller
         self.filePath = None
         self.changed = False
-        self.labelData = dict()  # Key: (volume, sliceType, sliceNum), Value: a dictionary containing:
-        # Labels as keys and values for the corresponding label
+        self.planes = [np.zeros((0, 0), np.uint8) for _ in PLANES]  # indexed like PLANES, bits set per label
+        self.labelBits = dict()  # Key: label, Value: bit position in the plane arrays
+        self.comments = dict()  # Key: (volume, sliceType, sliceNum), Value: comment
+        self.journal = Journal('_labels.journal')
+        self.database = None  # optional LabelDatabase, replaces the journal when set
 
-    def setFilePath(self, file):
+    def setDatabase(self, database):
+        self.database = database
+
+    def setFilePath(self, file, shape=None):
+        """shape is the shape of the nii data, used to preallocate the label arrays"""
         self.filePath = file
+        self.journal.setFilePath(file)
         self.clear()
         self.changed = False
-        self.readFromFile()
+
+        if shape is not None:
+            for plane, sliceType in enumerate(PLANES):
+                self.planes[plane] = np.zeros((shape[3], shape[PLANE_AXES[sliceType]]), self.planes[plane].dtype)
+
+        if self.database is not None and self.database.isSynced(file, 'labels_synced'):
+            for key, labels in self.database.getLabels(file).items():
+                self.setSliceLabels(*key, labels)
+        else:
+            self.readFromFile()
+            self.replayJournal()
+            if self.database is not None:
+                self.database.importLabels(file, self.items())
+
+    def replayJournal(self):
+        """Re-applies the label edits logged since the last compaction on top of the csv content"""
+        for row in self.journal.read():
+            try:
+                volume, sliceType, sliceNum, label, value = row
+                # comments are logged as their text, labels as 1 or 0
+                self.setBit(int(volume), sliceType, int(sliceNum), label, value if label == 'comment' else value == '1')
+            except ValueError:
+                continue  # torn row from an interrupted write
+            self.changed = True
 
     def printLabelData(self):
         """Print content to console for debug"""
         print('Printing label data content for current file:')
-        for key, val in self.labelData.items():
+        for key, labels in self.items():
             # print(f'=> {key}')
-            for label, labelVal in self.labelData[key].items():
+            for label, labelVal in labels.items():
                 # print(f'===========> {label}:{labelVal}')
                 pass
 
@@ -145,7 +302,7 @@ class LabelData:
         # self.printLabelData()
 
     def populateData(self, row):
-        """Gets a row from the csv file (label data for one slice), parse the content and add to the self.labelData"""
+        """Gets a row from the csv file (label data for one slice), parse the content and add to the label arrays"""
         sagittal = row[0]
         coronal = row[1]
         axial = row[2]
@@ -169,44 +326,56 @@ class LabelData:
             sliceType = 'Axial'
             sliceNum = int(axial)
 
-        if labelString != '':
-            labels = labelString.split('/')
-            labelsDict = dict()
-            for label in labels:
-                if label != '':
-                    labelsDict[label] = True
-            self.labelData[(vol, sliceType, sliceNum)] = labelsDict
+        if vol is None or sliceType is None:
+            return
+
+        labelsDict = dict()
+        for label in labelString.split('/'):
+            if label != '':
+                labelsDict[label] = True
+        if comment != '':
+            labelsDict['comment'] = comment
+        self.setSliceLabels(vol, sliceType, sliceNum, labelsDict)
 
         self.changed = False  # self.setLabel automatically switch self.changed to True, we overwrite it here to False
 
-    def saveToFile(self):
-        """Writes content of self.labelData to csv file in the same directory as the .nii image
-        Returns True if write is succesful, otherwise False"""
+    def compact(self):
+        """Exports the labels to csv file in the same directory as the .nii image and truncates the
+        journal. Returns True if write is succesful, otherwise False"""
         try:
             labelFile = os.path.splitext(self.filePath)[0] + '_labels.csv'
             # print(f'DEBUG: Writting to filename {labelFile}')
-            with open(labelFile, mode='w', newline='') as file:
-                writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(['slice_sagittal', 'slice_coronal', 'slice_axial', 'volume', 'labels', 'comment'])
+            rows = [['slice_sagittal', 'slice_coronal', 'slice_axial', 'volume', 'labels', 'comment']]
 
-                for (volume, sliceType, sliceNum) in self.labelData.keys():
-                    output = self.formatForCSV(volume, sliceType, sliceNum)
-                    if output is not None:
-                        writer.writerow(output)
+            for (volume, sliceType, sliceNum), labels in self.items():
+                output = self.formatForCSV(volume, sliceType, sliceNum, labels)
+                if output is not None:
+                    rows.append(output)
 
-            self.clear()
-            # print(f'DEBUG: Finished writing csv to file')
+            replaceFile(labelFile, rows)
+            self.journal.truncate()
+            self.changed = False
             return True
         except:
             # print(f'DEBUG: Error writing csv to file')
             return False
 
-    def formatForCSV(self, volume, sliceType, sliceNum):
+    def saveToFile(self):
+        """Compacts the journal into the csv file and releases the label data of the current file
+        Returns True if write is succesful, otherwise False"""
+        if self.compact():
+            self.clear()
+            # print(f'DEBUG: Finished writing csv to file')
+            return True
+        return False
+
+    def formatForCSV(self, volume, sliceType, sliceNum, labelsDict=None):
         """Create a list to be written to CSV as a row.
         This row format in csv is: slice_sagittal,slice_coronal,slice_axial,volume,labels,comment.
         The labels are separated by /"""
         output = list()
-        labelsDict = self.labelData[(volume, sliceType, sliceNum)]
+        if labelsDict is None:
+            labelsDict = self.getLabelsForSlice(volume, sliceType, sliceNum)
         labelString = ''
         comment = ''
 
@@ -231,29 +400,98 @@ class LabelData:
             return output
 
     def clear(self):
-        self.labelData.clear()
+        for plane in self.planes:
+            plane.fill(0)
+        self.comments.clear()
+
+    def getLabelBit(self, label):
+        """Returns the bit mask of a label, assigning the next free bit to labels not seen before"""
+        if label not in self.labelBits:
+            self.labelBits[label] = len(self.labelBits)
+            dtype = np.promote_types(self.planes[0].dtype, np.min_scalar_type(1 << self.labelBits[label]))
+            if dtype != self.planes[0].dtype:  # more label types than bits available
+                self.planes = [plane.astype(dtype) for plane in self.planes]
+        return self.planes[0].dtype.type(1 << self.labelBits[label])
+
+    def getPlane(self, sliceType, volume, sliceNum):
+        """Returns the label array of a plane, growing it if (volume, sliceNum) is outside of it"""
+        plane = PLANES.index(sliceType)
+        array = self.planes[plane]
+        if volume >= array.shape[0] or sliceNum >= array.shape[1]:
+            grown = np.zeros((max(volume + 1, array.shape[0]), max(sliceNum + 1, array.shape[1])), array.dtype)
+            grown[:array.shape[0], :array.shape[1]] = array
+            self.planes[plane] = array = grown
+        return array
+
+    def setBit(self, volume, sliceType, sliceNum, label, value):
+        if label == 'comment':
+            if value:
+                self.comments[(volume, sliceType, sliceNum)] = value
+            else:
+                self.comments.pop((volume, sliceType, sliceNum), None)
+            return
+        mask = self.getLabelBit(label)
+        array = self.getPlane(sliceType, volume, sliceNum)
+        if value is True:
+            array[volume, sliceNum] |= mask
+        else:
+            array[volume, sliceNum] &= ~mask
+
+    def setSliceLabels(self, volume, sliceType, sliceNum, labels):
+        """Sets all label values of a slice from a dictionary, key: label, value: label value"""
+        for label, value in labels.items():
+            self.setBit(volume, sliceType, sliceNum, label, value)
 
     def setLabel(self, volume, sliceType, sliceNum, label, value):
-        """Set a single label value for a slice, add/modify in data dictionary"""
+        """Set a single label value for a slice"""
         # print(f'DEBUG: Adding label {label}:{value} for vol {volume}, slice {sliceType} #{sliceNum}')
         self.changed = True
-
-        sliceLabels = dict()
-
-        if (volume, sliceType, sliceNum) in self.labelData.keys():
-            sliceLabels = self.labelData[(volume, sliceType, sliceNum)]
-        else:
-            sliceLabels[label] = value
-
-        self.labelData[(volume, sliceType, sliceNum)] = sliceLabels
+        self.setBit(volume, sliceType, sliceNum, label, value)
         # self.printLabelData()
 
+        if self.database is not None:
+            self.database.setLabel(self.filePath, volume, sliceType, sliceNum, label, value)
+        elif self.journal.append([volume, sliceType, sliceNum, label,
+                                  (value or '') if label == 'comment' else 1 if value is True else 0]):
+            self.compact()
+
     def getLabelsForSlice(self, volume, sliceType, sliceNum):
         """Get values of all labels for a slice, returns a dictionary
             where the key contains label, value contains label value"""
         sliceLabels = dict()
+        array = self.planes[PLANES.index(sliceType)]
+
+        if volume < array.shape[0] and sliceNum < array.shape[1]:
+            bits = int(array[volume, sliceNum])
+            for label, bit in self.labelBits.items():
+                if bits >> bit & 1:
+                    sliceLabels[label] = True
 
-        if (volume, sliceType, sliceNum) in self.labelData.keys():
-            sliceLabels = self.labelData[(volume, sliceType, sliceNum)]
+        if (volume, sliceType, sliceNum) in self.comments:
+            sliceLabels['comment'] = self.comments[(volume, sliceType, sliceNum)]
 
         return sliceLabels
+
+    def items(self):
+        """Yields ((volume, sliceType, sliceNum), labels dictionary) for every slice that has labels or a comment"""
+        keys = set(self.comments.keys())
+        for plane, sliceType in enumerate(PLANES):
+            for volume, sliceNum in zip(*np.nonzero(self.planes[plane])):
+                keys.add((int(volume), sliceType, int(sliceNum)))
+        for key in sorted(keys, key=lambda k: (k[0], PLANES.index(k[1]), k[2])):
+            yield key, self.getLabelsForSlice(*key)
+
+    def getLabelledVolumes(self, label=None):
+        """Returns a boolean array indexed by volume, True for volumes that have any label set on any slice,
+        or only the given label if provided"""
+        numVolumes = max(plane.shape[0] for plane in self.planes)
+        labelled = np.zeros(numVolumes, bool)
+        if label is not None and label not in self.labelBits:
+            return labelled
+        for plane in self.planes:
+            if label is not None:
+                hits = (plane & self.getLabelBit(label)).any(axis=1)
+            else:
+                hits = plane.any(axis=1)
+            labelled[:plane.shape[0]] |= hits
+        return labelled
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+
+# Voxels brighter than this fraction of the 99th percentile of the reference volume are brain
+BOX_THRESHOLD = 0.1
+# Voxels of padding around the thresholded brain
+BOX_MARGIN = 4
+
+
+def scanCacheKey(nii):
+    """Size and modification time of the scan file, None for scans not loaded from a file"""
+    filePath = nii.get_filename()
+    if not filePath:
+        return None
+    stat = os.stat(filePath)
+    return np.array([stat.st_size, stat.st_mtime])
+
+
+def brainBoundingBox(volume, threshold=BOX_THRESHOLD, margin=BOX_MARGIN):
+    """Returns the ((x0, x1), (y0, y1), (z0, z1)) half-open bounding box of the voxels of a 3D volume above
+    threshold times its 99th percentile, padded by margin. The whole volume when nothing is above the threshold"""
+    mask = volume > threshold * np.percentile(volume, 99)
+    box = list()
+    for axis in range(3):
+        present = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis)))
+        if len(present) == 0:
+            return tuple((0, size) for size in volume.shape)
+        box.append((max(int(present[0]) - margin, 0), min(int(present[-1]) + 1 + margin, volume.shape[axis])))
+    return tuple(box)
+
+
+def boxCachePath(nii):
+    return os.path.splitext(nii.get_filename())[0] + '_brainbox.npz'
+
+
+def scanBrainBox(nii, data=None):
+    """Brain bounding box of a scan, computed from its first volume (b0 in DWI, the brightest) and cached next to
+    the scan in _brainbox.npz. data is the scan's 4D data when it is already in memory"""
+    key = scanCacheKey(nii)
+    if key is not None and os.path.exists(boxCachePath(nii)):
+        with np.load(boxCachePath(nii)) as cache:
+            if np.array_equal(cache['key'], key):
+                return tuple(tuple(int(v) for v in axis) for axis in cache['box'])
+
+    volume = data[:, :, :, 0] if data is not None else np.asarray(nii.dataobj[..., 0], dtype=np.float64)
+    box = brainBoundingBox(volume)
+    if key is not None:
+        try:
+            np.savez(boxCachePath(nii), box=np.array(box), key=key)
+        except OSError:
+            print('DEBUG: failed to cache brain bounding box')
+    return box
+
+
+def planeBox(box, axis):
+    """The two in-plane ranges of the box for slices cut across axis (2 axial, 0 sagittal, 1 coronal)"""
+    return tuple(box[a] for a in range(3) if a != axis)
+
+
+def cropSlice(img, box, axis):
+    """Crops a 2D slice cut across axis to the box"""
+    (r0, r1), (c0, c1) = planeBox(box, axis)
+    return img[r0:r1, c0:c1]
+
+
+def cropPlanes(sagittal, coronal, box):
+    """Crops stacks of (slice, row, col) sagittal and coronal planes to the box"""
+    (sy0, sy1), (sz0, sz1) = planeBox(box, 0)
+    (cx0, cx1), (cz0, cz1) = planeBox(box, 1)
+    return sagittal[:, sy0:sy1, sz0:sz1], coronal[:, cx0:cx1, cz0:cz1]
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from Preprocessing import scanCacheKey
+
+PROJECTION_TYPES = ('Max', 'Mean')
+# Axis each plane's projection collapses, matching Models.PLANE_AXES
+PROJECTION_AXES = {'Axial': 2, 'Sagittal': 0, 'Coronal': 1}
+
+
+def computeProjections(data):
+    """Maximum and mean intensity projections of every volume of a 4D scan along each axis.
+    Returns {(type, plane): (volumes x rows x cols) float32 array}, each computed as one reduction over all volumes"""
+    projections = dict()
+    for plane, axis in PROJECTION_AXES.items():
+        projections['Max', plane] = np.moveaxis(np.max(data, axis=axis), -1, 0).astype(np.float32)
+        projections['Mean', plane] = np.moveaxis(np.mean(data, axis=axis), -1, 0).astype(np.float32)
+    return projections
+
+
+def projectionCachePath(nii):
+    return os.path.splitext(nii.get_filename())[0] + '_projections.npz'
+
+
+def scanProjections(nii, data):
+    """Projections of a scan, cached next to it in _projections.npz until the scan file changes"""
+    key = scanCacheKey(nii)
+    if key is not None and os.path.exists(projectionCachePath(nii)):
+        with np.load(projectionCachePath(nii)) as cache:
+            if np.array_equal(cache['key'], key):
+                return {(kind, plane): cache[kind + '_' + plane] for kind in PROJECTION_TYPES
+                        for plane in PROJECTION_AXES}
+
+    projections = computeProjections(data)
+    if key is not None:
+        try:
+            np.savez(projectionCachePath(nii), key=key,
+                     **{kind + '_' + plane: array for (kind, plane), array in projections.items()})
+        except OSError:
+            print('DEBUG: failed to cache projections')
+    return projections
+
+
+def thumbnail(projection, vmax):
+    """A projection as a uint8 image oriented like the slice views (rows top to bottom), scaled to vmax"""
+    image = np.clip(projection.T[::-1] / max(vmax, 1e-9) * 255, 0, 255)
+    return np.ascontiguousarray(image.astype(np.uint8))
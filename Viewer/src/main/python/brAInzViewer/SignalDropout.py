@@ -0,0 +1,35 @@
+import numpy as np
+
+# Volumes whose most dropped-out slice is this many robust standard deviations below normal are flagged
+DROPOUT_THRESHOLD = 5.0
+# Slices whose typical intensity is below this fraction of the brightest slice are background and ignored
+MIN_SIGNAL = 0.05
+
+
+def sliceIntensityMatrix(data):
+    """Mean intensity of every axial slice of every volume of a 4D scan, as a (volumes x slices) matrix.
+    data is the scan's 4D array, or a nii data object which is then read one volume at a time"""
+    if isinstance(data, np.ndarray):
+        return data.mean(axis=(0, 1)).T
+    return np.array([np.asarray(data[..., v], dtype=np.float64).mean(axis=(0, 1)) for v in range(data.shape[3])])
+
+
+def dropoutZScores(matrix, minSignal=MIN_SIGNAL):
+    """Robust z-scores of each slice's intensity against the same slice in the other volumes.
+    Each volume's profile is first divided by its median slice intensity so volumes of different b-values
+    are comparable, then every slice is scored with the median and MAD across volumes. Background slices are 0"""
+    matrix = np.asarray(matrix, np.float64)
+    scale = np.median(matrix, axis=1, keepdims=True)
+    profile = matrix / np.where(scale > 0, scale, 1)
+    median = np.median(profile, axis=0)
+    mad = 1.4826 * np.median(np.abs(profile - median), axis=0)
+    z = (profile - median) / np.where(mad > 0, mad, np.inf)
+    signal = np.median(matrix, axis=0)
+    z[:, signal < minSignal * np.max(signal)] = 0
+    return z
+
+
+def dropoutScores(data, minSignal=MIN_SIGNAL):
+    """Dropout score of every volume: how many robust standard deviations its darkest slice falls below normal,
+    0 for volumes without any below-normal slice"""
+    return np.maximum(-np.min(dropoutZScores(sliceIntensityMatrix(data), minSignal), axis=1), 0)
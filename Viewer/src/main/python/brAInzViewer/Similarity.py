@@ -0,0 +1,64 @@
+import numpy as np
+from AuxFiles import loadBval, scanStem
+
+# Every DOWNSAMPLE-th voxel along each axis is used for the similarity matrix
+DOWNSAMPLE = 4
+# b-values within this distance of each other belong to the same shell
+SHELL_TOLERANCE = 100
+# Volumes scoring above this are reported as outliers
+OUTLIER_THRESHOLD = 5.0
+
+
+def downsampleVolumes(data, factor=DOWNSAMPLE):
+    """Returns a (volumes x voxels) matrix of every factor-th voxel of each volume of a 4D scan.
+    data is the scan's 4D array, or a nii data object which is then read one volume at a time"""
+    if isinstance(data, np.ndarray):
+        return data[::factor, ::factor, ::factor, :].reshape(-1, data.shape[3]).T.astype(np.float32)
+    return np.array([np.asarray(data[..., v], dtype=np.float32)[::factor, ::factor, ::factor].ravel()
+                     for v in range(data.shape[3])])
+
+
+def correlationMatrix(volumes):
+    """N x N Pearson correlation of the rows of a (volumes x voxels) matrix, as one matrix product"""
+    centered = volumes - volumes.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    normalized = centered / np.where(norms > 0, norms, 1)
+    return normalized @ normalized.T
+
+
+def shellGroups(bval, numVolumes, tolerance=SHELL_TOLERANCE):
+    """Shell index of every volume, b-values rounded to the tolerance. One shell when b-values are unknown"""
+    if bval is None or len(bval) != numVolumes:
+        return np.zeros(numVolumes, int)
+    return np.unique(np.round(np.asarray(bval) / tolerance), return_inverse=True)[1].reshape(-1)
+
+
+def outlierScores(correlation, groups):
+    """How far each volume deviates from its shell: the robust z-score (median/MAD within the shell) of the
+    volume's median correlation to the other volumes of its shell, positive when less similar than its peers.
+    0 for volumes alone in their shell"""
+    numVolumes = len(correlation)
+    sameShell = (groups[:, None] == groups[None, :]) & ~np.eye(numVolumes, dtype=bool)
+    peerCorrelation = np.where(sameShell, correlation, np.nan)
+    hasPeers = sameShell.any(axis=1)
+    similarity = np.full(numVolumes, np.nan)
+    similarity[hasPeers] = np.nanmedian(peerCorrelation[hasPeers], axis=1)
+
+    scores = np.zeros(numVolumes)
+    for group in np.unique(groups[hasPeers]):
+        members = (groups == group) & hasPeers
+        median = np.median(similarity[members])
+        mad = 1.4826 * np.median(np.abs(similarity[members] - median))
+        if mad > 0:
+            scores[members] = (median - similarity[members]) / mad
+    return scores
+
+
+def scanOutliers(niiPath, data):
+    """Returns (scores, ranking, bval) of a scan: the outlier score of every volume, the volumes from most to least
+    deviating, and the b-values read from the .bval file next to the scan (None if there is none).
+    data is the scan's 4D array or nii data object"""
+    bval = loadBval(scanStem(niiPath) + '.bval')
+    correlation = correlationMatrix(downsampleVolumes(data))
+    scores = outlierScores(correlation, shellGroups(bval, len(correlation)))
+    return scores, np.argsort(-scores, kind='stable'), bval
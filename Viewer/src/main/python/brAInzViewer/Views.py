@@ -1,12 +1,16 @@
 from PyQt5.QtWidgets import (QMainWindow, QVBoxLayout, QSizePolicy,
                              QWidget, QPushButton, QSlider, QHBoxLayout,
-                             QGridLayout, QLabel, QListWidget, QFrame, QLayout, QAction)
-from PyQt5.QtCore import Qt, pyqtSlot, QMetaObject, QSize
+                             QGridLayout, QLabel, QListWidget, QFrame, QLayout, QAction, QComboBox, QScrollArea)
+from PyQt5.QtCore import Qt, pyqtSlot, QMetaObject, QSize, QTimer
+from PyQt5.QtGui import QImage, QPixmap
 
 from PyQt5 import QtGui
 from sys import platform
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+from Projections import PROJECTION_TYPES, PROJECTION_AXES, thumbnail
+import numpy as np
 
 VOX_MAX_VAL = 5000
 
@@ -37,6 +41,19 @@ class View(QMainWindow):
         setExportFolderButton.triggered.connect(self.setExportFolderButtonPressed)
         fileMenu.addAction(setExportFolderButton)
 
+        showProjectionsButton = QAction('Show Volume Projections', self)
+        showProjectionsButton.triggered.connect(self.showProjectionsButtonPressed)
+        fileMenu.addAction(showProjectionsButton)
+
+        rankOutliersButton = QAction('Rank Outlier Volumes', self)
+        rankOutliersButton.triggered.connect(self.rankOutliersButtonPressed)
+        fileMenu.addAction(rankOutliersButton)
+
+        showBrainBoxButton = QAction('Show Brain Box', self)
+        showBrainBoxButton.setCheckable(True)
+        showBrainBoxButton.triggered[bool].connect(self.showBrainBoxButtonPressed)
+        fileMenu.addAction(showBrainBoxButton)
+
         self.resize(1280, 600)
         self.setWindowTitle("br[AI]nz Viewer")
         self.show()
@@ -47,6 +64,15 @@ class View(QMainWindow):
     def saveFileButtonPressed(self):
         self.controller.saveNillFile()
 
+    def showProjectionsButtonPressed(self):
+        self.controller.showProjectionGrid()
+
+    def rankOutliersButtonPressed(self):
+        self.controller.showOutlierRanking()
+
+    def showBrainBoxButtonPressed(self, checked):
+        self.controller.setShowBrainBox(checked)
+
     def analyzeAllButtonPressed(self):
         self.controller.detectBadVolumes(batch=True)
 
@@ -174,6 +200,114 @@ class SliderTicker(QWidget):
             self.layout().itemAt(i).widget().deleteLater()
 
 
+class ProjectionThumbnail(QLabel):
+    """A volume's projection in the ProjectionGridView, clicking it selects the volume"""
+
+    def __init__(self, controller, volume):
+        super(ProjectionThumbnail, self).__init__()
+        self.controller = controller
+        self.volume = volume
+        self.setToolTip('Volume ' + str(volume + 1))
+        self.setAlignment(Qt.AlignCenter)
+
+    def mousePressEvent(self, event):
+        self.controller.selectVolume(self.volume)
+
+
+class ProjectionGridView(QWidget):
+    """Compact grid of per-volume maximum or mean intensity projections, linked to the volume slider.
+    Thumbnails are rendered a few at a time from a timer so large series stay responsive while they fill in"""
+
+    thumbnailSize = 96
+    columns = 10
+    renderBatch = 8  # thumbnails rendered per timer tick
+
+    def __init__(self, controller):
+        super(ProjectionGridView, self).__init__()
+        self.controller = controller
+        self.projections = None
+        self.thumbnails = list()
+        self.nextThumbnail = 0
+        self.currentVolume = None
+        self.vmax = 1
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.renderNext)
+
+        self.typeSelector = QComboBox()
+        self.typeSelector.addItems(list(PROJECTION_TYPES))
+        self.typeSelector.currentIndexChanged.connect(self.layoutThumbnails)
+        self.planeSelector = QComboBox()
+        self.planeSelector.addItems(list(PROJECTION_AXES.keys()))
+        self.planeSelector.currentIndexChanged.connect(self.layoutThumbnails)
+
+        self.grid = QGridLayout()
+        self.grid.setSpacing(2)
+        gridWidget = QWidget()
+        gridWidget.setLayout(self.grid)
+        scrollArea = QScrollArea()
+        scrollArea.setWidgetResizable(True)
+        scrollArea.setWidget(gridWidget)
+
+        hbox = QHBoxLayout()
+        hbox.addWidget(self.typeSelector)
+        hbox.addWidget(self.planeSelector)
+        vbox = QVBoxLayout()
+        vbox.addLayout(hbox)
+        vbox.addWidget(scrollArea)
+        self.setLayout(vbox)
+
+        self.setWindowTitle('Volume Projections')
+        self.resize(self.columns * (self.thumbnailSize + 2) + 60, 500)
+
+    def setProjections(self, projections):
+        self.projections = projections
+        self.layoutThumbnails()
+
+    def layoutThumbnails(self):
+        """Lays out empty thumbnails for every volume and starts filling them in"""
+        self.timer.stop()
+        for thumbnailLabel in self.thumbnails:
+            self.grid.removeWidget(thumbnailLabel)
+            thumbnailLabel.deleteLater()
+        self.thumbnails = list()
+        if self.projections is None:
+            return
+
+        key = (self.typeSelector.currentText(), self.planeSelector.currentText())
+        # One brightness scale for every volume, so darker volumes stand out
+        self.vmax = np.percentile(self.projections[key], 99)
+        for v in range(len(self.projections[key])):
+            thumbnailLabel = ProjectionThumbnail(self.controller, v)
+            thumbnailLabel.setFixedSize(self.thumbnailSize, self.thumbnailSize)
+            self.grid.addWidget(thumbnailLabel, v // self.columns, v % self.columns)
+            self.thumbnails.append(thumbnailLabel)
+        self.nextThumbnail = 0
+        self.setCurrentVolume(self.currentVolume)
+        self.timer.start(0)
+
+    def renderNext(self):
+        key = (self.typeSelector.currentText(), self.planeSelector.currentText())
+        end = min(self.nextThumbnail + self.renderBatch, len(self.thumbnails))
+        for v in range(self.nextThumbnail, end):
+            image = thumbnail(self.projections[key][v], self.vmax)
+            qImage = QImage(image.tobytes(), image.shape[1], image.shape[0], image.strides[0], QImage.Format_Grayscale8)
+            pixmap = QPixmap.fromImage(qImage.copy()).scaled(self.thumbnailSize - 4, self.thumbnailSize - 4,
+                                                             Qt.KeepAspectRatio)
+            self.thumbnails[v].setPixmap(pixmap)
+        self.nextThumbnail = end
+        if self.nextThumbnail >= len(self.thumbnails):
+            self.timer.stop()
+
+    def setCurrentVolume(self, volume):
+        """Highlights the thumbnail of the volume selected on the slider"""
+        if self.currentVolume is not None and self.currentVolume < len(self.thumbnails):
+            self.thumbnails[self.currentVolume].setStyleSheet('')
+        self.currentVolume = volume
+        if volume is not None and volume < len(self.thumbnails):
+            self.thumbnails[volume].setStyleSheet('border: 2px solid yellow;')
+
+
 class VolumeSelectView(QWidget):
     """Top QWidget class, contains other view classes, contains slider for Volume selection"""
 
@@ -199,6 +333,8 @@ class VolumeSelectView(QWidget):
 
         self.labelIndicatorTicker = SliderTicker()
 
+        self.dropoutScoreTicker = SliderTicker()
+
         self.volumeLabel.setText('0')
 
         # Left-half: data display area
@@ -213,6 +349,7 @@ class VolumeSelectView(QWidget):
 
         vbox.addWidget(self.volumeExclusionTicker)
         vbox.addWidget(self.labelIndicatorTicker)
+        vbox.addWidget(self.dropoutScoreTicker)
         vbox.addWidget(triPlaneView)
         vbox.addWidget(brightnessSelector)
 
@@ -222,11 +359,13 @@ class VolumeSelectView(QWidget):
             self.volumeExclusionTicker.setContentsMargins(0, 0, 0, 0)
             self.predictionScoreTicker.setContentsMargins(0, 0, 0, 0)
             self.labelIndicatorTicker.setContentsMargins(0, 0, 0, 0)
+            self.dropoutScoreTicker.setContentsMargins(0, 0, 0, 0)
         else:
             hbox.setContentsMargins(0, 0, 0, 0)
             self.volumeExclusionTicker.setContentsMargins(5, 0, 0, 0)
             self.predictionScoreTicker.setContentsMargins(5, 0, 0, 0)
             self.labelIndicatorTicker.setContentsMargins(5, 0, 0, 0)
+            self.dropoutScoreTicker.setContentsMargins(5, 0, 0, 0)
 
         # Right-half: file list area
         hbox = QHBoxLayout()
@@ -252,6 +391,7 @@ class VolumeSelectView(QWidget):
         self.volumeExclusionTicker.setTicks(self.controller.getVolumeSliderExclusionTicksData())
         self.labelIndicatorTicker.setTicks(self.controller.getVolumeSliderLabelIndicatorTicksData())
         self.predictionScoreTicker.setTicks(self.controller.getVolumeSliderPredictionScoreTicksData())
+        self.dropoutScoreTicker.setTicks(self.controller.getVolumeSliderDropoutTicksData())
 
 
 class DisplayBrightnessSelectorView(QWidget):
@@ -570,3 +710,9 @@ class PlotCanvas(FigureCanvas):
             self.ax.axvline(x=lines['coronal_v'], color='green', linewidth=linewidth, linestyle=linestyle)
 
         self.draw()
+
+    def plotBox(self, horizontal, vertical):
+        """Plots the brain bounding box, given as (start, end) ranges along the horizontal and vertical axes"""
+        self.ax.add_patch(Rectangle((horizontal[0] - 0.5, vertical[0] - 0.5), horizontal[1] - horizontal[0],
+                                    vertical[1] - vertical[0], fill=False, edgecolor='yellow', linewidth=1))
+        self.draw()